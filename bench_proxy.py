@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Load test the generic proxy against a local stand-in upstream
+
+    python bench_proxy.py [--requests 2000] [--concurrency 300] [--delay 0.2] [--clients 4]
+    python bench_proxy.py --workers 1,2,4 [--threads 32]
+
+Starts a slow keep-alive upstream and the load generators in their own
+processes, then fires concurrent requests for distinct pages through
+/http.<upstream>/... and reports throughput, latency and how many upstream
+connections the proxy opened. The app runs on a threaded server in this
+process, or with --workers under gunicorn once per worker count, to show how
+throughput scales.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logzero
+import requests
+from werkzeug.serving import make_server
+
+# keep the benchmark's pages out of the real web cache
+os.environ.setdefault('ADHDPROXY_WEB_CACHE', os.path.join(tempfile.mkdtemp(), 'bench.cache'))
+
+import flaskapp  # noqa: E402
+
+class SlowUpstream(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+    delay = 0.2
+
+    connections = set()
+
+    def do_GET(self):
+        if self.path == '/connections':
+            return self.send_body(str(len(self.connections)).encode(), 'text/plain')
+        self.connections.add(self.client_address)
+        time.sleep(self.delay)
+        links = ''.join(f'<li><a href="/item?id={i}">item {i}</a></li>' for i in range(50))
+        body = f'<html><body><h1>{self.path}</h1><ul>{links}</ul></body></html>'.encode()
+        self.send_body(body, 'text/html; charset=utf-8')
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class UpstreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def run_upstream(port, delay):
+    SlowUpstream.delay = delay
+    UpstreamServer(('127.0.0.1', port), SlowUpstream).serve_forever()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_load(urls, concurrency):
+    """Fetch urls from one client process; returns per-request latencies"""
+    local = threading.local()
+
+    def fetch(url):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        r = local.session.get(url, timeout=60)
+        r.raise_for_status()
+        assert '/item?id=0' in r.text and '/http.' in r.text
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(fetch, urls))
+
+
+def start_gunicorn(port, workers, threads):
+    """Serve the app from production-mode gunicorn workers; returns the process once it's listening"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-k', 'gthread', '--threads', str(threads),
+         '--backlog', '2048', '-b', f'127.0.0.1:{port}', '--chdir', here, 'flaskapp:app'],
+        env=dict(os.environ, FLASK_ENV='production'), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('gunicorn did not start')
+
+
+def measure(label, proxy_port, upstream_host, args):
+    run = str(time.time())
+    urls = [f'http://127.0.0.1:{proxy_port}/http.{upstream_host}/page?run={run}&n={i}'
+            for i in range(args.requests)]
+    chunks = [(urls[i::args.clients], max(1, args.concurrency // args.clients)) for i in range(args.clients)]
+    connections = int(requests.get(f'http://{upstream_host}/connections').text)
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.clients) as pool:
+        latencies = sorted(sum(pool.starmap(run_load, chunks), []))
+    elapsed = time.perf_counter() - start
+    connections = int(requests.get(f'http://{upstream_host}/connections').text) - connections
+
+    print(f'{label:<18} {elapsed:>8.2f}s {args.requests / elapsed:>8.0f} req/s '
+          f'{statistics.median(latencies) * 1000:>8.0f}ms {latencies[int(len(latencies) * 0.95) - 1] * 1000:>8.0f}ms '
+          f'{connections:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=300, help='total in-flight requests')
+    parser.add_argument('--delay', type=float, default=0.2, help='seconds the upstream takes per page')
+    parser.add_argument('--clients', type=int, default=4, help='load generator processes')
+    parser.add_argument('--workers', help='comma separated gunicorn worker counts to compare')
+    parser.add_argument('--threads', type=int, default=32, help='threads per gunicorn worker')
+    args = parser.parse_args()
+
+    logzero.loglevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    upstream_port = free_port()
+    upstream = multiprocessing.Process(target=run_upstream, args=(upstream_port, args.delay), daemon=True)
+    upstream.start()
+    upstream_host = f'127.0.0.1:{upstream_port}'
+    time.sleep(0.5)
+
+    print(f'{args.requests} requests, {args.concurrency} concurrent, upstream delay {args.delay * 1000:.0f}ms '
+          f'(serial would take {args.requests * args.delay:.0f}s), {os.cpu_count()} cpus')
+    print(f'{"server":<18} {"wall":>9} {"throughput":>14} {"p50":>10} {"p95":>10} {"upstream conns":>14}')
+    try:
+        if not args.workers:
+            proxy = make_server('127.0.0.1', free_port(), flaskapp.app, threaded=True)
+            proxy.socket.listen(1024)
+            threading.Thread(target=proxy.serve_forever, daemon=True).start()
+            measure('werkzeug threaded', proxy.server_port, upstream_host, args)
+            return
+
+        for workers in [int(w) for w in args.workers.split(',')]:
+            port = free_port()
+            proc = start_gunicorn(port, workers, args.threads)
+            try:
+                measure(f'gunicorn {workers}x{args.threads}', port, upstream_host, args)
+            finally:
+                proc.terminate()
+                proc.wait()
+    finally:
+        upstream.terminate()
+
+
+if __name__ == '__main__':
+    main()
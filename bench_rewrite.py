@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Benchmark the single-pass URL rewriter against the old replace_urls
+
+    python bench_rewrite.py [saved_page.html | directory ...] [--url https://site/page] [--repeat 5]
+
+With no pages given a synthetic page is generated for a range of link counts.
+Needs BeautifulSoup for the old implementation: pip install -r requirements-bench.txt
+"""
+
+import argparse
+import glob
+import os
+import time
+
+from bs4 import BeautifulSoup
+
+from flaskapp import UrlRewriter, rewrite_urls
+
+
+def replace_urls(html, domain, protocol=None):
+    """The previous implementation (minus debug logging), kept for comparison"""
+    soup = BeautifulSoup(html, 'html.parser')
+    arefs = soup.find_all('a')
+    arefs = [x.attrs.get('href') for x in arefs]
+    arefs = [x for x in arefs if x and x is not None]
+    arefs = sorted(set(arefs))
+
+    for idx, x in enumerate(arefs):
+        if x.startswith('//'):
+            arefs[idx] = '/' + x.lstrip('/')
+
+    for aref in arefs:
+        naref = None
+        if aref.startswith('/'):
+            if domain:
+                naref = '/' + domain + aref
+            else:
+                naref = '/' + aref
+        elif aref.startswith('https://'):
+            naref = aref.replace('https://', 'https.')
+        elif aref.startswith('http://'):
+            naref = aref.replace('http://', 'http.')
+        else:
+            naref = '/' + protocol + '.' + domain + '/' + aref
+
+        if naref:
+            naref = naref.lstrip('/')
+            if naref.startswith('http'):
+                naref = '/' + naref
+            html = html.replace('href="' + aref, 'href="' + naref)
+            html = html.replace('src="' + aref, 'src="' + naref)
+            html = html.replace('="' + aref, '="' + naref)
+
+    html = html.replace('="https://', '="/https.')
+    html = html.replace('="http://', '="/http.')
+
+    return html
+
+
+def synthetic_page(links):
+    rows = []
+    for i in range(links):
+        rows.append(
+            f'<tr><td><a href="item?id={i}">Story number {i}</a> '
+            f'<a href="/user?id=u{i % 97}">u{i % 97}</a> '
+            f'<a href="https://example{i % 13}.com/post/{i}">link</a> '
+            f'<img src="/img/{i}.png" srcset="/img/{i}.png 1x, /img/{i}@2x.png 2x"></td></tr>'
+        )
+    return '<html><head><script src="/app.js"></script></head><body><table>' + '\n'.join(rows) + '</table></body></html>'
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench(name, html, url, repeat):
+    o = url.split('://', 1)
+    protocol, domain = o[0], o[1].split('/')[0]
+    old = best_of(repeat, lambda: replace_urls(html, domain, protocol=protocol))
+    new = best_of(repeat, lambda: rewrite_urls(html, url))
+
+    def chunked():
+        rewriter = UrlRewriter(url)
+        for i in range(0, len(html), 64 * 1024):
+            rewriter.feed(html[i:i + 64 * 1024])
+        rewriter.close()
+
+    streamed = best_of(repeat, chunked)
+    print(f'{name:<32} {len(html) / 1024:>8.0f}KB {old * 1000:>10.1f}ms {new * 1000:>10.1f}ms '
+          f'{streamed * 1000:>10.1f}ms {old / new:>8.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*')
+    parser.add_argument('--url', default='https://news.example.com/news', help='page url used to resolve links')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'{"page":<32} {"size":>10} {"replace_urls":>12} {"rewriter":>12} {"streamed":>12} {"speedup":>9}')
+    if not args.pages:
+        for links in (100, 1000, 5000):
+            bench(f'synthetic ({links} rows)', synthetic_page(links), args.url, args.repeat)
+        return
+
+    for page in args.pages:
+        files = sorted(glob.glob(os.path.join(page, '*.htm*'))) if os.path.isdir(page) else [page]
+        for fn in files:
+            with open(fn, encoding='utf-8', errors='replace') as f:
+                bench(os.path.basename(fn), f.read(), args.url, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
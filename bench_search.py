@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Time library text searches against a synthetic metadata index
+
+    python bench_search.py [--videos 100000] [--db /tmp/bench-index] [--repeat 5]
+
+Builds (or reuses) an index of synthetic videos whose words follow a Zipf-like
+distribution, so there are words matching a handful of videos and words
+matching most of them, then times the first page of query_library for each
+query and sort order.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+import flaskapp
+
+WORDS = [f'w{i}' for i in range(20000)]
+WEIGHTS = [1 / (i + 1) for i in range(len(WORDS))]
+# Words are prefix-matched like the app does, so 'w1' also matches w10, w100, ...
+QUERIES = {
+    'rare word': 'w15000',
+    'mid word': 'w3000',
+    'common word': 'w30',
+    'prefix': 'w1',
+    'two words': 'w2 w5',
+}
+
+
+def words(rng, count):
+    return ' '.join(rng.choices(WORDS, WEIGHTS, k=count))
+
+
+def build(videos):
+    rng = random.Random(1)
+    conn = flaskapp.get_index_db()
+    with conn:
+        for i in range(videos):
+            video_id = f'v{i:010d}'
+            tags = words(rng, 5).split()
+            cur = conn.execute(
+                'INSERT INTO videos (id, title, channel_id, uploader, timestamp, duration, tags, categories, '
+                "data_file, files, bytes) VALUES (?, ?, ?, ?, ?, ?, ?, '[]', '', '[]', 0)",
+                (video_id, words(rng, 8), f'c{i % 2000}', f'uploader {i % 2000}', 1600000000 + i * 60,
+                 rng.randint(30, 7200), json.dumps(tags)))
+            conn.execute(
+                'INSERT INTO video_search (rowid, title, uploader, tags, categories, description, transcript) '
+                "VALUES (?, ?, ?, ?, '', ?, ?)",
+                (cur.lastrowid, words(rng, 8), f'uploader {i % 2000}', ' '.join(tags), words(rng, 60),
+                 words(rng, 600) if i % 5 == 0 else ''))
+
+
+def timed(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--videos', type=int, default=100000)
+    parser.add_argument('--db', default='/tmp/bench-index', help='directory for the synthetic index')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.makedirs(args.db, exist_ok=True)
+    flaskapp.youtubecache = args.db
+    flaskapp.youtubecache_db = os.path.join(args.db, 'index.sqlite')
+    conn = flaskapp.get_index_db()
+    if conn.execute('SELECT COUNT(*) FROM videos').fetchone()[0] != args.videos:
+        conn.execute('DELETE FROM videos')
+        conn.execute('DELETE FROM video_search')
+        start = time.perf_counter()
+        build(args.videos)
+        print(f'indexed {args.videos} synthetic videos in {time.perf_counter() - start:.0f}s')
+
+    sorts = ('relevance', 'newest', 'title')
+    print(f'{"query":<14} {"matches":>8} ' + ' '.join(f'{s:>10}' for s in sorts))
+    for name, text in QUERIES.items():
+        query = flaskapp.search_query(text)
+        matches = conn.execute('SELECT COUNT(*) FROM video_search WHERE video_search MATCH ?', (query,)).fetchone()[0]
+        times = [timed(args.repeat, lambda: flaskapp.query_library(sort, text=text)) for sort in sorts]
+        print(f'{name:<14} {matches:>8} ' + ' '.join(f'{t * 1000:>8.0f}ms' for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,5 +20,8 @@ else
     echo "Using existing SSL certificate"
 fi
 
-# Start the Flask app
+# Start the app: gunicorn worker processes in production, the Flask server otherwise
+if [ "$FLASK_ENV" = "production" ]; then
+    exec gunicorn -c gunicorn.conf.py flaskapp:app
+fi
 exec python flaskapp.py
@@ -1,115 +1,2119 @@
 #!/usr/bin/env python
 
+import atexit
+import base64
+import codecs
+import fcntl
 import glob
+import gzip
+import io
 import json
+import mimetypes
 import os
-import subprocess
+import queue
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 
 import requests
 import requests_cache
+import yt_dlp
 from logzero import logger
-from urllib.parse import urlparse, quote_plus
+from PIL import Image
+from urllib.parse import urlparse, urljoin, parse_qs, quote_plus, urlencode
 
-from bs4 import BeautifulSoup
+from markupsafe import Markup, escape
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import redirect
 from flask import render_template
 from flask import request
-from flask import send_from_directory
 from flask import send_file
+from flask import g
 
 
 
 app = Flask(__name__)
-app.config['TEMPLATES_AUTO_RELOAD'] = True  # Reload templates on every request
-requests_cache.install_cache('/tmp/r.cache', expire_after=86400)  # 1 day = 86400 seconds
-session = requests.Session()
+production = os.environ.get('FLASK_ENV') == 'production'
+app.config['TEMPLATES_AUTO_RELOAD'] = not production  # Reload templates on every request in development
+proxy_cache_max_body = 2 * 1024 * 1024  # non-HTML bodies larger than this stream uncached
+rewrite_cache_max_bytes = int(os.environ.get('ADHDPROXY_REWRITE_CACHE_MB', 64)) * 1024 * 1024
+# Upstream connections are kept alive and pooled per host; requests beyond the
+# pool size still go out, they just don't get their connection reused.
+upstream_pool_hosts = int(os.environ.get('ADHDPROXY_UPSTREAM_POOL_HOSTS', 64))
+upstream_pool_size = int(os.environ.get('ADHDPROXY_UPSTREAM_POOL_SIZE', 64))
+upstream_timeout = (float(os.environ.get('ADHDPROXY_UPSTREAM_CONNECT_TIMEOUT', 5)),
+                    float(os.environ.get('ADHDPROXY_UPSTREAM_READ_TIMEOUT', 30)))
+PROXY_HEADERS = ('Content-Type', 'Cache-Control', 'Expires', 'Last-Modified', 'ETag',
+                 'Content-Disposition', 'Content-Language', 'Accept-Ranges')
+# A rewritten page is a different body, so its upstream ETag and ranges don't apply
+REWRITTEN_HEADERS = ('Cache-Control', 'Expires', 'Last-Modified', 'Content-Language')
+
+
+def is_html(content_type):
+    """Pages get their links rewritten; everything else is passed through untouched"""
+    content_type = (content_type or 'text/html').split(';')[0].strip().lower()
+    return content_type in ('text/html', 'application/xhtml+xml')
+
+
+def cacheable_response(response):
+    """Only cache responses small enough to buffer; large assets are streamed instead"""
+    if is_html(response.headers.get('Content-Type')):
+        return True
+    length = response.headers.get('Content-Length')
+    return length is not None and length.isdigit() and int(length) <= proxy_cache_max_body
+
+
+web_cache_path = os.environ.get('ADHDPROXY_WEB_CACHE', '/tmp/r.cache')
+web_cache_max_bytes = int(os.environ.get('ADHDPROXY_WEB_CACHE_MB', 512)) * 1024 * 1024
+web_cache_policy_file = os.environ.get('ADHDPROXY_CACHE_POLICY', 'cache_policy.json')
+
+# TTLs in seconds. Domain rules cover the host and its subdomains and win over
+# content-type rules, which match exactly or by major type ('image/*'). Expired
+# responses are still served for stale_while_revalidate seconds while a
+# background request refreshes them.
+WEB_CACHE_POLICY = {
+    'default_ttl': 86400,
+    'stale_while_revalidate': 86400,
+    'domains': {},
+    'content_types': {
+        'text/html': 3600,
+        'text/css': 7 * 86400,
+        'text/javascript': 7 * 86400,
+        'application/javascript': 7 * 86400,
+        'image/*': 30 * 86400,
+        'font/*': 30 * 86400,
+    },
+}
+
+
+def load_cache_policy():
+    """The default cache policy with cache_policy.json, if present, layered on top"""
+    policy = {k: dict(v) if isinstance(v, dict) else v for k, v in WEB_CACHE_POLICY.items()}
+    if os.path.exists(web_cache_policy_file):
+        with open(web_cache_policy_file, 'r') as f:
+            for key, value in json.load(f).items():
+                if isinstance(value, dict):
+                    policy.setdefault(key, {}).update(value)
+                else:
+                    policy[key] = value
+    return policy
+
+
+cache_policy = load_cache_policy()
+
+
+def policy_ttl(url, content_type):
+    """Seconds a response for this url and content type stays fresh"""
+    domains = cache_policy['domains']
+    host = (urlparse(url).hostname or '').lower()
+    while host:
+        if host in domains:
+            return domains[host]
+        host = host.partition('.')[2]
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    types = cache_policy['content_types']
+    for key in (content_type, content_type.split('/')[0] + '/*'):
+        if key in types:
+            return types[key]
+    return cache_policy['default_ttl']
+
+
+def cache_target_matcher(target):
+    """Match urls on a domain (and its subdomains) or, if it has a path, under a url prefix"""
+    target = target.strip()
+    if '/' not in target:
+        domain = target.lower().strip('.')
+
+        def match(url):
+            host = (urlparse(url).hostname or '').lower()
+            return host == domain or host.endswith('.' + domain)
+        return match
+    prefixes = (target,) if '://' in target else ('http://' + target, 'https://' + target)
+    return lambda url: url.startswith(prefixes)
+
+
+class ProxyCache(requests_cache.SQLiteCache):
+    """requests_cache SQLite backend that applies the cache policy and an LRU size cap.
+
+    An entries table next to the responses records each response's url, size and
+    last access. It shares the backend's connection and lock, so trimming, clearing
+    and invalidating are ordinary transactions that in-flight requests wait on.
+    """
+
+    def __init__(self, db_path, max_bytes):
+        super().__init__(db_path, wal=True, busy_timeout=5000)
+        self.max_bytes = max_bytes
+        self.init_entries()
+
+    def init_entries(self):
+        with self.responses.connection(commit=True) as con:
+            con.execute('CREATE TABLE IF NOT EXISTS entries '
+                        '(key TEXT PRIMARY KEY, url TEXT, size INTEGER, last_access REAL)')
+            con.execute('CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access)')
+            # responses cached before this table existed go first when trimming
+            con.execute('INSERT OR IGNORE INTO entries (key, size, last_access) '
+                        'SELECT key, length(value), 0 FROM responses')
+
+    def save_response(self, response, cache_key=None, expires=None):
+        cache_key = cache_key or self.create_key(response.request)
+        ttl = policy_ttl(response.url, response.headers.get('Content-Type'))
+        super().save_response(response, cache_key, requests_cache.get_expiration_datetime(ttl))
+        with self.responses.connection(commit=True) as con:
+            con.execute('INSERT OR REPLACE INTO entries (key, url, size, last_access) '
+                        'SELECT key, ?, length(value), ? FROM responses WHERE key = ?',
+                        (response.url, time.time(), cache_key))
+        self.trim()
+
+    def get_response(self, key, default=None):
+        response = super().get_response(key, default)
+        if response is not default:
+            with self.responses.connection(commit=True) as con:
+                con.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+        return response
+
+    def total_bytes(self):
+        with self.responses.connection() as con:
+            return con.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def trim(self):
+        """Evict least recently used responses until the cache is back under 90% of its cap"""
+        if self.total_bytes() <= self.max_bytes:
+            return
+        with self.responses.connection(commit=True) as con:
+            # responses requests_cache deleted on its own (e.g. filtered out) leave stale entries
+            con.execute('DELETE FROM entries WHERE key NOT IN (SELECT key FROM responses)')
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        with self.responses.connection() as con:
+            rows = con.execute('SELECT key, size FROM entries ORDER BY last_access').fetchall()
+        keys = []
+        freed = 0
+        for key, size in rows:
+            if total - freed <= self.max_bytes * 0.9:
+                break
+            keys.append(key)
+            freed += size or 0
+        self.forget(keys)
+        logger.info(f'web cache over {self.max_bytes} bytes, evicted {len(keys)} responses ({freed} bytes)')
+
+    def forget(self, keys):
+        if not keys:
+            return
+        self.delete(*keys, vacuum=False)
+        with self.responses.connection(commit=True) as con:
+            con.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+
+    def invalidate(self, match):
+        """Drop every cached response whose url matches; returns how many were dropped"""
+        with self.responses.connection() as con:
+            rows = con.execute('SELECT key, url FROM entries WHERE url IS NOT NULL').fetchall()
+        keys = [key for key, url in rows if match(url)]
+        self.forget(keys)
+        return len(keys)
+
+    def clear(self):
+        """Empty the cache in one transaction. The inherited clear drops and vacuums
+        the tables, and unlinks the database under open connections if that fails."""
+        with self.responses.connection(commit=True) as con:
+            con.execute(f'DELETE FROM {self.responses.table_name}')
+            con.execute(f'DELETE FROM {self.redirects.table_name}')
+            con.execute('DELETE FROM entries')
+
+    def stats(self):
+        with self.responses.connection() as con:
+            entries, size = con.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'entries': entries, 'bytes': size, 'max_bytes': self.max_bytes}
+
+
+web_cache = ProxyCache(web_cache_path, web_cache_max_bytes)
+session = requests_cache.CachedSession(
+    backend=web_cache,
+    expire_after=cache_policy['default_ttl'],
+    stale_while_revalidate=cache_policy['stale_while_revalidate'],
+    filter_fn=cacheable_response,
+)
+upstream_adapter = requests.adapters.HTTPAdapter(pool_connections=upstream_pool_hosts,
+                                                 pool_maxsize=upstream_pool_size)
+session.mount('http://', upstream_adapter)
+session.mount('https://', upstream_adapter)
+# requests_cache reads a whole body before returning it, so pages that aren't
+# cached yet are fetched without it and cached once they have been streamed
+upstream_session = requests.Session()
+upstream_session.mount('http://', upstream_adapter)
+upstream_session.mount('https://', upstream_adapter)
 #youtubecache = '/tmp/youtubevids'
 youtubecache = 'youtube_cache'
 youtubecache_index = '/tmp/youtubevids/index.json'
+youtubecache_db = os.path.join(youtubecache, 'index.sqlite')
 favorites_file = 'favorites.json'
+favorites_flush_delay = 1.0  # seconds to coalesce favorites changes into one write
+# Advisory locks that serialize writers across worker processes
+lock_dir = os.environ.get('ADHDPROXY_LOCK_DIR', '/tmp/adhdproxy-locks')
+
+# Per-video metadata: a slim summary for listings and the full yt-dlp info,
+# compressed, for the single video view. data.json is the legacy format.
+SUMMARY_FIELDS = ('id', 'title', 'channel_id', 'channel', 'uploader', 'upload_date', 'timestamp',
+                  'duration', 'duration_string', 'tags', 'categories', 'description', 'thumbnail')
+METADATA_FILES = ('summary.json', 'info.json.gz', 'data.json')
+reconcile_interval = int(os.environ.get('ADHDPROXY_RECONCILE_INTERVAL', 60))
+journal_max = 10000
+index_version = 3
+facet_sidebar_size = 200
+library_page_size = 50
+library_max_page_size = 500
+search_rank_limit = 5000  # matches ranked by relevance per text search
+download_workers = int(os.environ.get('ADHDPROXY_DOWNLOAD_WORKERS', 2))
+ytdl_pool_size = int(os.environ.get('ADHDPROXY_YTDL_POOL', 4))
+stream_chunk_size = 64 * 1024
+stream_wait_timeout = 30  # seconds to wait for a stalled download before giving up
+# Media files are evicted once youtube_cache passes the quota or the disk's free
+# space drops below the floor; 0 disables either limit
+media_quota_bytes = int(float(os.environ.get('ADHDPROXY_MEDIA_QUOTA_GB', 0)) * 1024 ** 3)
+media_min_free_bytes = int(float(os.environ.get('ADHDPROXY_MIN_FREE_GB', 0)) * 1024 ** 3)
+media_eviction = os.environ.get('ADHDPROXY_EVICTION', 'lru')  # 'lru' or 'lfu'
+media_access_interval = 60  # seconds between recorded accesses of the same file
+refresh_workers = int(os.environ.get('ADHDPROXY_REFRESH_WORKERS', 8))  # concurrent yt-dlp calls for channel refreshes
+youtube_rate = float(os.environ.get('ADHDPROXY_YOUTUBE_RATE', 5))  # requests per second to YouTube
+refresh_retries = 3  # retries of a throttled request
+rate_limit_max_backoff = 300  # seconds
+refresh_interval = int(os.environ.get('ADHDPROXY_REFRESH_INTERVAL', 0))  # seconds between favorites refreshes; 0 = off
+search_cache_ttl = int(os.environ.get('ADHDPROXY_SEARCH_TTL', 3600))  # seconds a search's results are reused
+search_cache_size = 100  # queries
+prefetch_max_height = int(os.environ.get('ADHDPROXY_PREFETCH_HEIGHT', 720))  # tallest format a watch link prefetches
+# Watch links on proxied pages and channel listings are read ahead into the
+# cache, up to this many videos an hour; 0 = off. Metadata only, unless
+# ADHDPROXY_READAHEAD_MEDIA=1 also downloads their default format.
+readahead_per_hour = int(os.environ.get('ADHDPROXY_READAHEAD_PER_HOUR', 0))
+readahead_media = os.environ.get('ADHDPROXY_READAHEAD_MEDIA') == '1'
+readahead_queue_size = 200
+readahead_channel_videos = 10  # newest videos of a viewed channel to read ahead
+transcript_workers = int(os.environ.get('ADHDPROXY_TRANSCRIPT_WORKERS', 4))  # concurrent subtitle downloads per batch
+transcript_page_bytes = 16 * 1024  # transcript text per /transcript/<id>.json page
+thumbnail_workers = int(os.environ.get('ADHDPROXY_THUMBNAIL_WORKERS', 4))  # concurrent downloads in a backfill
+thumbnail_max_age = 30 * 86400  # seconds browsers may reuse a thumbnail without asking
+metrics_flush_interval = 10  # seconds between a gunicorn worker's metrics snapshots
+
+# sort name -> (key expression, direction); NULLs are coalesced so keyset comparisons work
+LIBRARY_SORTS = {
+    'newest': ('videos.timestamp', 'DESC'),
+    'oldest': ('videos.timestamp', 'ASC'),
+    'title': ("COALESCE(videos.title, '')", 'ASC'),
+    'longest': ('COALESCE(videos.duration, 0)', 'DESC'),
+    'shortest': ('COALESCE(videos.duration, 0)', 'ASC'),
+}
+valid_video_dir = re.compile(r'^[A-Za-z0-9_-]+$')
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS videos (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    channel_id TEXT,
+    uploader TEXT,
+    upload_date TEXT,
+    timestamp INTEGER NOT NULL DEFAULT 0,
+    duration REAL,
+    duration_string TEXT,
+    tags TEXT NOT NULL DEFAULT '[]',
+    categories TEXT NOT NULL DEFAULT '[]',
+    data_file TEXT,
+    files TEXT NOT NULL DEFAULT '[]',
+    bytes INTEGER NOT NULL DEFAULT 0
+);
+DROP INDEX IF EXISTS videos_timestamp;
+CREATE INDEX IF NOT EXISTS videos_newest ON videos(timestamp, id);
+CREATE INDEX IF NOT EXISTS videos_title ON videos(COALESCE(title, ''), id);
+CREATE INDEX IF NOT EXISTS videos_duration ON videos(COALESCE(duration, 0), id);
+CREATE INDEX IF NOT EXISTS videos_channel ON videos(channel_id, timestamp);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id TEXT PRIMARY KEY,
+    name TEXT,
+    video_count INTEGER NOT NULL,
+    latest_timestamp INTEGER NOT NULL,
+    total_duration REAL NOT NULL,
+    total_bytes INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS videos_channel_add AFTER INSERT ON videos WHEN new.channel_id IS NOT NULL BEGIN
+    INSERT INTO channels (channel_id, name, video_count, latest_timestamp, total_duration, total_bytes)
+        VALUES (new.channel_id, new.uploader, 1, new.timestamp, COALESCE(new.duration, 0), new.bytes)
+        ON CONFLICT (channel_id) DO UPDATE SET
+            name = COALESCE(new.uploader, name),
+            video_count = video_count + 1,
+            latest_timestamp = MAX(latest_timestamp, new.timestamp),
+            total_duration = total_duration + COALESCE(new.duration, 0),
+            total_bytes = total_bytes + new.bytes;
+END;
+CREATE TRIGGER IF NOT EXISTS videos_channel_remove AFTER DELETE ON videos WHEN old.channel_id IS NOT NULL BEGIN
+    UPDATE channels SET
+        video_count = video_count - 1,
+        latest_timestamp = COALESCE((SELECT MAX(timestamp) FROM videos WHERE channel_id = old.channel_id), 0),
+        total_duration = total_duration - COALESCE(old.duration, 0),
+        total_bytes = total_bytes - old.bytes
+        WHERE channel_id = old.channel_id;
+    DELETE FROM channels WHERE channel_id = old.channel_id AND video_count <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS videos_channel_bytes AFTER UPDATE OF bytes ON videos WHEN new.channel_id IS NOT NULL BEGIN
+    UPDATE channels SET total_bytes = total_bytes - old.bytes + new.bytes WHERE channel_id = new.channel_id;
+END;
+CREATE TABLE IF NOT EXISTS cache_dirs (
+    name TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    dir_mtime INTEGER,
+    data_mtime INTEGER,
+    data_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    action TEXT NOT NULL,
+    video_id TEXT NOT NULL
+);
+-- Not in INDEX_TABLES: watch history can't be rebuilt from youtube_cache
+CREATE TABLE IF NOT EXISTS media_access (
+    video_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL,
+    PRIMARY KEY (video_id, filename)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS video_facets (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    PRIMARY KEY (kind, value, video_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS video_facets_video ON video_facets(video_id);
+CREATE TABLE IF NOT EXISTS facet_counts (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (kind, value)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS facet_counts_top ON facet_counts(kind, count);
+CREATE TRIGGER IF NOT EXISTS video_facets_add AFTER INSERT ON video_facets BEGIN
+    INSERT INTO facet_counts (kind, value, count) VALUES (new.kind, new.value, 1)
+        ON CONFLICT (kind, value) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS video_facets_remove AFTER DELETE ON video_facets BEGIN
+    UPDATE facet_counts SET count = count - 1 WHERE kind = old.kind AND value = old.value;
+    DELETE FROM facet_counts WHERE kind = old.kind AND value = old.value AND count <= 0;
+END;
+CREATE VIRTUAL TABLE IF NOT EXISTS video_search USING fts5(
+    title, uploader, tags, categories, description, transcript,
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+'''
+
+INDEX_TABLES = ('videos', 'channels', 'cache_dirs', 'journal', 'video_facets', 'facet_counts', 'video_search')
+
+_index_local = threading.local()
+
+
+@app.template_filter('filesize')
+def filesize_filter(num):
+    """Format a byte count for display"""
+    num = num or 0
+    if num > 1073741824:
+        return '%.1f GB' % (num / 1073741824)
+    if num > 1048576:
+        return '%.1f MB' % (num / 1048576)
+    return '%.1f KB' % (num / 1024)
+
+
+@app.template_filter('hours')
+def hours_filter(seconds):
+    """Format a number of seconds as hours and minutes"""
+    minutes = int(seconds or 0) // 60
+    if minutes >= 60:
+        return f'{minutes // 60}h {minutes % 60}m'
+    return f'{minutes}m'
+
+
+@contextmanager
+def file_lock(name, blocking=True):
+    """Hold an exclusive flock shared by every worker process; yields False if
+    non-blocking and another holder has it"""
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, name.replace('/', '_') + '.lock'), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def tmp_name(path):
+    """A temporary name next to path that no other process or thread is writing"""
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+
+def job_state_path(kind, key):
+    return os.path.join(lock_dir, 'jobs', kind, key.replace('/', '_') + '.json')
+
+
+def publish_job(kind, key, state, active):
+    """Record a job's status where every worker process can read it"""
+    path = job_state_path(kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(tmp_name(path), 'w') as f:
+        json.dump(dict(state, active=active, pid=os.getpid(), updated_at=time.time()), f)
+    os.replace(tmp_name(path), path)
+
+
+def publish_while_running(job, kind, key):
+    """Publish job.to_dict() every half second until job.done is set, then once more"""
+    def loop():
+        while not job.done.wait(0.5):
+            publish_job(kind, key, job.to_dict(), True)
+        publish_job(kind, key, job.to_dict(), False)
+
+    publish_job(kind, key, job.to_dict(), True)
+    threading.Thread(target=loop, name=f'publish-{kind}', daemon=True).start()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def shared_job(kind, key):
+    """The last published status of a job, whichever worker ran it; None if there is none.
+
+    A job whose worker exited before it finished is reported as failed.
+    """
+    try:
+        with open(job_state_path(kind, key)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state['active'] and not process_alive(state['pid']):
+        state.update(status='failed', error='the worker running it exited', active=False)
+    return state
+
+
+def shared_jobs(kind):
+    """Published statuses of every job of a kind"""
+    names = glob.glob(os.path.join(lock_dir, 'jobs', kind, '*.json'))
+    states = [shared_job(kind, os.path.basename(name)[:-len('.json')]) for name in names]
+    return [state for state in states if state is not None]
+
+
+def clear_shared_state():
+    """Forget job statuses and metrics snapshots left by a previous run"""
+    for name in ('jobs', 'metrics'):
+        shutil.rmtree(os.path.join(lock_dir, name), ignore_errors=True)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+YTDL_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+class Metric:
+    """A Prometheus counter or histogram, with one value per set of label values.
+
+    Histogram values are [cumulative bucket counts..., sum, count], so samples
+    from several processes merge by adding them up.
+    """
+
+    def __init__(self, name, doc, labels=(), buckets=None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.kind = 'histogram' if buckets else 'counter'
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {labels: list(v) if self.buckets else v for labels, v in self.values.items()}
+
+
+metrics = {}
+
+
+def metric(name, doc, labels=(), buckets=None):
+    metrics[name] = Metric(name, doc, labels, buckets)
+    return metrics[name]
+
+
+request_seconds = metric('adhdproxy_request_duration_seconds', 'Time to serve a request, including streamed bodies',
+                         ('route', 'method', 'status'), LATENCY_BUCKETS)
+web_cache_requests = metric('adhdproxy_web_cache_requests_total', 'Proxied fetches by web cache outcome', ('result',))
+upstream_seconds = metric('adhdproxy_upstream_seconds', 'Time until an upstream response (or cached one) is ready',
+                          ('cache',), LATENCY_BUCKETS)
+rewrite_seconds = metric('adhdproxy_rewrite_seconds', 'Time spent rewriting the links of one page', (), LATENCY_BUCKETS)
+rewrite_cache_requests = metric('adhdproxy_rewrite_cache_requests_total', 'Rewritten page cache lookups', ('result',))
+ytdl_seconds = metric('adhdproxy_ytdl_seconds', 'Duration of yt-dlp calls', ('kind',), YTDL_BUCKETS)
+ytdl_errors = metric('adhdproxy_ytdl_errors_total', 'yt-dlp calls that raised', ('kind',))
+reconcile_seconds = metric('adhdproxy_reconcile_seconds', 'Duration of index reconcile passes', (), YTDL_BUCKETS)
+
+
+@contextmanager
+def ytdl_timed(kind):
+    """Count and time one yt-dlp call"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ytdl_errors.inc(kind)
+        raise
+    finally:
+        ytdl_seconds.observe(time.perf_counter() - start, kind)
+
+
+# Snapshot name: the pid alone could be reused by a later worker of the same run
+metrics_process_id = f'{os.getpid()}-{time.time_ns()}'
+
+
+def metrics_path():
+    return os.path.join(lock_dir, 'metrics', f'{metrics_process_id}.json')
+
+
+def write_metrics_snapshot():
+    """Save this process's metrics where the other workers' /metrics can add them up"""
+    path = metrics_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {m.name: [[list(labels), v] for labels, v in m.snapshot().items()] for m in metrics.values()}
+    with open(tmp_name(path), 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_name(path), path)
+
+
+def metrics_flush_loop():
+    while True:
+        time.sleep(metrics_flush_interval)
+        try:
+            write_metrics_snapshot()
+        except Exception as e:
+            logger.exception(e)
+
+
+def start_metrics_flusher():
+    """Under gunicorn every worker has its own counters; snapshot them periodically"""
+    thread = threading.Thread(target=metrics_flush_loop, name='metrics-flusher', daemon=True)
+    thread.start()
+    return thread
+
+
+def collect_metrics():
+    """name -> {label values: value} for this process plus the latest snapshots of other workers.
+
+    Snapshots of workers that have exited are kept, so totals don't go backwards
+    when gunicorn replaces a worker; they're cleared when the server starts.
+    """
+    merged = {name: m.snapshot() for name, m in metrics.items()}
+    own = metrics_path()
+    for path in glob.glob(os.path.join(lock_dir, 'metrics', '*.json')) if production else []:
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, samples in data.items():
+            values = merged.get(name)
+            if values is None:
+                continue
+            for labels, value in samples:
+                labels = tuple(labels)
+                if labels not in values:
+                    values[labels] = value
+                elif isinstance(value, list):
+                    values[labels] = [a + b for a, b in zip(values[labels], value)]
+                else:
+                    values[labels] += value
+    return merged
+
+
+def histogram_quantile(counts, buckets, q):
+    """Upper bound of the bucket holding the q-th quantile, None past the last bucket"""
+    for bound, n in zip(buckets, counts):
+        if n >= q * counts[-1]:
+            return bound
+    return None
+
+
+def format_labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
 
 
 def load_favorites():
-    """Load favorites from JSON file"""
-    if os.path.exists(favorites_file):
+    """Load favorites from JSON file, with the file's (mtime, size) stamp"""
+    try:
         with open(favorites_file, 'r') as f:
-            return json.load(f)
-    return {'videos': [], 'channels': []}
+            st = os.fstat(f.fileno())
+            return json.load(f), (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return {'videos': [], 'channels': []}, None
 
 
 def save_favorites(favorites):
-    """Save favorites to JSON file"""
-    with open(favorites_file, 'w') as f:
+    """Save favorites to JSON file, atomically; returns the new file's stamp"""
+    tmp_file = tmp_name(favorites_file)
+    with open(tmp_file, 'w') as f:
         json.dump(favorites, f, indent=2)
+    os.replace(tmp_file, favorites_file)
+    st = os.stat(favorites_file)
+    return st.st_mtime_ns, st.st_size
+
+
+class FavoritesStore:
+    """favorites.json kept in memory with set lookups and atomic saves.
+
+    Changes are applied in memory at once and queued. Routes that change
+    favorites and redirect flush before answering, so the page the redirect
+    lands on shows the change whichever worker renders it; other changes are
+    flushed shortly after. A flush takes the favorites file lock, reloads the file if another worker process
+    wrote it meanwhile, replays the queued changes on top and writes the result,
+    so concurrent edits from different processes are merged rather than lost
+    (for the same item changed in two processes within one flush delay, the
+    later flush wins).
+    Reads notice other processes' saves by checking the file's stamp, at most
+    once per check_interval (by default on every read, which costs one stat).
+    """
 
+    def __init__(self, flush_delay=1.0, check_interval=0.0):
+        self.flush_delay = flush_delay
+        self.check_interval = check_interval
+        self.lock = threading.RLock()
+        self.videos = {}  # video id -> None; a dict keeps insertion order
+        self.channels = {}  # channel id -> {'id': ..., 'name': ...}
+        self.pending = []  # (kind, item_id, add, name) not yet written
+        self.stamp = False  # stamp of the file last loaded or written; False until loaded
+        self.checked = 0
+        self.timer = None
+
+    def _load(self, data, stamp):
+        self.videos = dict.fromkeys(data.get('videos', []))
+        self.channels = {c['id']: c for c in data.get('channels', [])}
+        self.stamp = stamp
+        for change in self.pending:
+            self._apply(*change)
+
+    def _apply(self, kind, item_id, add, name=None):
+        if kind == 'video' and add:
+            self.videos.setdefault(item_id)
+        elif kind == 'video':
+            self.videos.pop(item_id, None)
+        elif add:
+            self.channels.setdefault(item_id, {'id': item_id, 'name': name})
+        else:
+            self.channels.pop(item_id, None)
+
+    def sync(self):
+        """Reload if another process saved the file since we last looked"""
+        now = time.monotonic()
+        if self.stamp is not False and now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        try:
+            st = os.stat(favorites_file)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        with self.lock:
+            if stamp != self.stamp:
+                self._load(*load_favorites())
+
+    def change(self, kind, item_id, add, name=None):
+        """Apply a change now and schedule it to be written"""
+        self.sync()
+        with self.lock:
+            self._apply(kind, item_id, add, name)
+            self.pending.append((kind, item_id, add, name))
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Write queued changes, merged with whatever is on disk now"""
+        with file_lock('favorites'), self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                return
+            data, stamp = load_favorites()
+            if stamp != self.stamp:
+                self._load(data, stamp)
+            self.stamp = save_favorites(self._snapshot())
+            self.pending = []
+
+    def add_video(self, video_id):
+        self.change('video', video_id, True)
+
+    def remove_videos(self, *video_ids):
+        for video_id in video_ids:
+            self.change('video', video_id, False)
+
+    def add_channel(self, channel_id, name):
+        self.change('channel', channel_id, True, name)
+
+    def remove_channel(self, channel_id):
+        self.change('channel', channel_id, False)
+
+    def has_video(self, video_id):
+        self.sync()
+        return video_id in self.videos
+
+    def has_channel(self, channel_id):
+        self.sync()
+        return channel_id in self.channels
+
+    def _snapshot(self):
+        with self.lock:
+            return {'videos': list(self.videos), 'channels': list(self.channels.values())}
+
+    def to_dict(self):
+        self.sync()
+        return self._snapshot()
+
+
+favorites_store = FavoritesStore(flush_delay=favorites_flush_delay)
+atexit.register(favorites_store.flush)
+
+
+def get_index_db():
+    """Return this thread's connection to the metadata index"""
+    conn = getattr(_index_local, 'conn', None)
+    if conn is None:
+        if not os.path.exists(youtubecache):
+            os.makedirs(youtubecache)
+        conn = sqlite3.connect(youtubecache_db, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Only one worker creates or rebuilds the schema; the rest wait and reuse it
+        with file_lock('index-schema'):
+            outdated = conn.execute('PRAGMA user_version').fetchone()[0] < index_version
+            if outdated:
+                # Everything in the index is derived from youtube_cache, so schema
+                # changes are handled by dropping it and rebuilding from disk
+                for table in INDEX_TABLES:
+                    conn.execute(f'DROP TABLE IF EXISTS {table}')
+            conn.executescript(INDEX_SCHEMA)
+            _index_local.conn = conn
+            if outdated:
+                rebuild_index()
+                conn.execute(f'PRAGMA user_version = {index_version}')
+    return conn
+
+
+def video_row(row):
+    """Convert an index row into the dict the templates expect"""
+    video = dict(row)
+    video['tags'] = json.loads(video['tags'])
+    video['categories'] = json.loads(video['categories'])
+    video['files'] = json.loads(video['files'])
+    return video
+
+
+def read_transcript(video_id):
+    """Contents of a cached video's transcript.txt, or an empty string"""
+    transcript_file = os.path.join(youtubecache, video_id, 'transcript.txt')
+    if not os.path.exists(transcript_file):
+        return ''
+    with open(transcript_file, 'r', encoding='utf-8') as f:
+        return f.read()
 
-def replace_urls(html, domain, protocol=None):
-    soup = BeautifulSoup(html,'html.parser')
-    arefs = soup.findAll('a')
-    arefs = [x.attrs.get('href') for x in arefs]
-    arefs = [x for x in arefs if x and x is not None]
-    arefs = sorted(set(arefs))
 
-    for idx,x in enumerate(arefs):
-        if x.startswith('//'):
-            arefs[idx] = '/' + x.lstrip('/')
+def record_cache_dir(conn, name, status, dir_mtime=None, data_mtime=None, data_size=None):
+    """Remember what a cache directory looked like when it was last reconciled"""
+    conn.execute(
+        'INSERT OR REPLACE INTO cache_dirs (name, status, dir_mtime, data_mtime, data_size) '
+        'VALUES (?, ?, ?, ?, ?)', (name, status, dir_mtime, data_mtime, data_size))
 
-    for aref in arefs:
-        logger.debug(aref)
-        naref = None
-        if aref.startswith('/'):
-            if domain:
-                naref = '/' + domain + aref
-            else:
-                naref = '/' + aref
-        elif aref.startswith('https://'):
-            naref = aref.replace('https://', 'https.')
-        elif aref.startswith('http://'):
-            naref = aref.replace('http://', 'http.')
+
+def record_journal(conn, action, video_id):
+    """Append an add/update/delete entry to the index change journal"""
+    conn.execute('INSERT INTO journal (ts, action, video_id) VALUES (?, ?, ?)',
+                 (time.time(), action, video_id))
+
+
+def scan_video_dir(vdir):
+    """File names (besides metadata) and total bytes in a video's cache directory"""
+    files = []
+    total = 0
+    if not os.path.isdir(vdir):
+        return files, total
+    with os.scandir(vdir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            total += entry.stat().st_size
+            if entry.name not in METADATA_FILES:
+                files.append(entry.name)
+    return sorted(files), total
+
+
+def index_video(ds):
+    """Insert or refresh a video's summary in the metadata index"""
+    if not ds or not isinstance(ds, dict) or 'id' not in ds:
+        return
+    vdir = os.path.join(youtubecache, ds['id'])
+    data_file = metadata_path(vdir)
+    files, size = scan_video_dir(vdir)
+    tags = [x for x in (ds.get('tags') or []) if isinstance(x, str)]
+    categories = [x for x in (ds.get('categories') or []) if isinstance(x, str)]
+    conn = get_index_db()
+    with conn:
+        exists = conn.execute('SELECT rowid FROM videos WHERE id = ?', (ds['id'],)).fetchone()
+        if exists:
+            # Delete rather than REPLACE so the channel aggregate triggers fire
+            conn.execute('DELETE FROM video_search WHERE rowid = ?', (exists[0],))
+            conn.execute('DELETE FROM videos WHERE id = ?', (ds['id'],))
+        cur = conn.execute(
+            'INSERT INTO videos (id, title, channel_id, uploader, upload_date, timestamp, '
+            'duration, duration_string, tags, categories, data_file, files, bytes) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (ds['id'], ds.get('title'), ds.get('channel_id'), ds.get('uploader'),
+             ds.get('upload_date'), ds.get('timestamp') or 0, ds.get('duration'),
+             ds.get('duration_string'), json.dumps(tags), json.dumps(categories),
+             data_file, json.dumps(files), size))
+        conn.execute(
+            'INSERT INTO video_search (rowid, title, uploader, tags, categories, description, transcript) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (cur.lastrowid, ds.get('title') or '', ds.get('uploader') or '', ' '.join(tags),
+             ' '.join(categories), ds.get('description') or '', read_transcript(ds['id'])))
+        conn.execute('DELETE FROM video_facets WHERE video_id = ?', (ds['id'],))
+        conn.executemany('INSERT OR IGNORE INTO video_facets (kind, value, video_id) VALUES (?, ?, ?)',
+                         [('tag', x, ds['id']) for x in tags] +
+                         [('category', x, ds['id']) for x in categories])
+        record_journal(conn, 'update' if exists else 'add', ds['id'])
+        try:
+            st = os.stat(data_file)
+            record_cache_dir(conn, ds['id'], 'ok', os.stat(vdir).st_mtime_ns, st.st_mtime_ns, st.st_size)
+        except OSError:
+            pass
+
+
+def index_video_files(video_id):
+    """Refresh the list of files the index holds for a cached video"""
+    vdir = os.path.join(youtubecache, video_id)
+    if not os.path.isdir(vdir):
+        return
+    files, size = scan_video_dir(vdir)
+    conn = get_index_db()
+    with conn:
+        conn.execute('UPDATE videos SET files = ?, bytes = ? WHERE id = ?', (json.dumps(files), size, video_id))
+        conn.execute('UPDATE video_search SET transcript = ? WHERE rowid = (SELECT rowid FROM videos WHERE id = ?)',
+                     (read_transcript(video_id), video_id))
+        conn.execute('UPDATE cache_dirs SET dir_mtime = ? WHERE name = ?',
+                     (os.stat(vdir).st_mtime_ns, video_id))
+
+
+def unindex_video(video_id):
+    """Drop a video from the metadata index"""
+    conn = get_index_db()
+    with conn:
+        conn.execute('DELETE FROM video_search WHERE rowid = (SELECT rowid FROM videos WHERE id = ?)', (video_id,))
+        conn.execute('DELETE FROM video_facets WHERE video_id = ?', (video_id,))
+        cur = conn.execute('DELETE FROM videos WHERE id = ?', (video_id,))
+        conn.execute('DELETE FROM cache_dirs WHERE name = ?', (video_id,))
+        conn.execute('DELETE FROM media_access WHERE video_id = ?', (video_id,))
+        if cur.rowcount:
+            record_journal(conn, 'delete', video_id)
+
+
+def metadata_path(vdir):
+    """The file holding a video's listing metadata: summary.json, or a legacy data.json"""
+    summary_file = os.path.join(vdir, 'summary.json')
+    if os.path.exists(summary_file) or not os.path.exists(os.path.join(vdir, 'data.json')):
+        return summary_file
+    return os.path.join(vdir, 'data.json')
+
+
+def video_summary(ds):
+    """The subset of yt-dlp info the listing views and the index need"""
+    return {k: ds.get(k) for k in SUMMARY_FIELDS}
+
+
+def has_video_data(video_id):
+    """Whether metadata for a video is already cached"""
+    vdir = os.path.join(youtubecache, video_id)
+    return any(os.path.exists(os.path.join(vdir, x)) for x in ('summary.json', 'data.json'))
+
+
+def load_video_summary(video_id):
+    """A cached video's summary, read from summary.json or a legacy data.json"""
+    with open(metadata_path(os.path.join(youtubecache, video_id)), 'r') as f:
+        ds = json.loads(f.read())
+    return video_summary(ds) if isinstance(ds, dict) else ds
+
+
+def load_video_info(video_id):
+    """A cached video's full yt-dlp info, read from info.json.gz or a legacy data.json"""
+    vdir = os.path.join(youtubecache, video_id)
+    info_file = os.path.join(vdir, 'info.json.gz')
+    if os.path.exists(info_file):
+        with gzip.open(info_file, 'rt', encoding='utf-8') as f:
+            return json.loads(f.read())
+    with open(os.path.join(vdir, 'data.json'), 'r') as f:
+        return json.loads(f.read())
+
+
+def save_video_data(ds):
+    """Write a video's yt-dlp info as summary.json plus info.json.gz and index it"""
+    vdir = os.path.join(youtubecache, ds['id'])
+    if not os.path.exists(vdir):
+        os.makedirs(vdir)
+
+    # Write to temporary names and rename so readers never see partial files;
+    # the summary goes last since its presence marks the video as cached
+    info_file = os.path.join(vdir, 'info.json.gz')
+    tmp_file = tmp_name(info_file)
+    with gzip.open(tmp_file, 'wt', encoding='utf-8', compresslevel=6) as f:
+        f.write(json.dumps(ds, separators=(',', ':')))
+    os.replace(tmp_file, info_file)
+
+    summary_file = os.path.join(vdir, 'summary.json')
+    tmp_file = tmp_name(summary_file)
+    with open(tmp_file, 'w') as f:
+        f.write(json.dumps(video_summary(ds)))
+    os.replace(tmp_file, summary_file)
+
+    legacy_file = os.path.join(vdir, 'data.json')
+    if os.path.exists(legacy_file):
+        os.remove(legacy_file)
+    index_video(ds)
+
+
+def migrate_video_dir(vdir):
+    """Convert a legacy data.json into summary.json plus info.json.gz.
+
+    Returns (old bytes, new bytes, seconds to parse data.json, seconds to parse
+    summary.json), or None if there was nothing to migrate.
+    """
+    legacy_file = os.path.join(vdir, 'data.json')
+    if not os.path.exists(legacy_file):
+        return None
+    old_size = os.path.getsize(legacy_file)
+    start = time.time()
+    with open(legacy_file, 'r') as f:
+        ds = json.loads(f.read())
+    old_read = time.time() - start
+    if not ds or not isinstance(ds, dict) or ds.get('id') != os.path.basename(vdir):
+        return None
+
+    save_video_data(ds)
+
+    new_size = sum(os.path.getsize(os.path.join(vdir, x)) for x in ('summary.json', 'info.json.gz'))
+    start = time.time()
+    load_video_summary(ds['id'])
+    new_read = time.time() - start
+    return old_size, new_size, old_read, new_read
+
+
+def reconcile_index():
+    """Bring the index in line with youtube_cache.
+
+    Only metadata files whose mtime or size changed since the last pass are
+    parsed again, so a pass over an unchanged cache costs one stat per video.
+    """
+    conn = get_index_db()
+    known = {r['name']: r for r in conn.execute('SELECT * FROM cache_dirs')}
+    counts = {'added': 0, 'updated': 0, 'deleted': 0, 'invalid': 0}
+    seen = set()
+
+    with os.scandir(youtubecache) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            name = entry.name
+            seen.add(name)
+            prev = known.get(name)
+            dir_mtime = entry.stat().st_mtime_ns
+
+            # Artifacts like "abc123?list=..." left behind by bad proxy paths
+            if not valid_video_dir.match(name):
+                if prev is None:
+                    logger.warning(f'Skipping malformed cache directory: {name}')
+                    with conn:
+                        record_cache_dir(conn, name, 'malformed', dir_mtime)
+                    counts['invalid'] += 1
+                continue
+
+            data_file = metadata_path(entry.path)
+            try:
+                st = os.stat(data_file)
+            except FileNotFoundError:
+                # No metadata (e.g. a yt-dlp run that crashed before writing it)
+                if prev is None or prev['status'] != 'missing':
+                    if prev is not None and prev['status'] == 'ok':
+                        unindex_video(name)
+                        counts['deleted'] += 1
+                    with conn:
+                        record_cache_dir(conn, name, 'missing', dir_mtime)
+                continue
+
+            if prev is not None and prev['data_mtime'] == st.st_mtime_ns and prev['data_size'] == st.st_size:
+                if prev['status'] == 'ok' and prev['dir_mtime'] != dir_mtime:
+                    # Media or transcript files came or went
+                    index_video_files(name)
+                continue
+
+            try:
+                with open(data_file, 'r') as f:
+                    ds = json.loads(f.read())
+            except Exception as e:
+                logger.warning(f'Skipping unreadable data file in {name}: {e}')
+                ds = None
+
+            if not ds or not isinstance(ds, dict) or ds.get('id') != name:
+                if prev is not None and prev['status'] == 'ok':
+                    unindex_video(name)
+                    counts['deleted'] += 1
+                with conn:
+                    record_cache_dir(conn, name, 'invalid', dir_mtime, st.st_mtime_ns, st.st_size)
+                counts['invalid'] += 1
+                continue
+
+            index_video(ds)
+            counts['updated' if prev is not None and prev['status'] == 'ok' else 'added'] += 1
+
+    for name, prev in known.items():
+        if name in seen:
+            continue
+        if prev['status'] == 'ok':
+            unindex_video(name)
+            counts['deleted'] += 1
         else:
-            # <a href="item?id=19638991">
-            naref = '/' + protocol + '.' + domain + '/' + aref
+            with conn:
+                conn.execute('DELETE FROM cache_dirs WHERE name = ?', (name,))
+
+    with conn:
+        conn.execute('DELETE FROM journal WHERE seq <= (SELECT MAX(seq) FROM journal) - ?', (journal_max,))
+
+    if any(counts.values()):
+        logger.info(f'Reconciled index: {counts}')
+    return counts
+
+
+def rebuild_index():
+    """Forget recorded cache state and re-read all cached metadata into the index"""
+    conn = get_index_db()
+    with conn:
+        conn.execute('DELETE FROM cache_dirs')
+    reconcile_index()
+
+    # Drop rows whose directories no longer hold valid metadata
+    stale = [r['id'] for r in conn.execute(
+        "SELECT id FROM videos WHERE id NOT IN (SELECT name FROM cache_dirs WHERE status = 'ok')")]
+    for video_id in stale:
+        unindex_video(video_id)
+    count = conn.execute('SELECT COUNT(*) FROM videos').fetchone()[0]
+    logger.info(f'Indexed {count} videos, dropped {len(stale)} stale entries')
+    return count
+
+
+def reconcile_loop():
+    """Periodically reconcile the index with changes made outside the app"""
+    while True:
+        try:
+            # With several workers each running this loop, one reconciles per pass
+            with file_lock('reconcile', blocking=False) as held:
+                if held:
+                    start = time.perf_counter()
+                    reconcile_index()
+                    reconcile_seconds.observe(time.perf_counter() - start)
+            enforce_media_quota()
+        except Exception as e:
+            logger.exception(e)
+        time.sleep(reconcile_interval)
+
+
+def start_reconciler():
+    """Start the background index reconciler thread"""
+    thread = threading.Thread(target=reconcile_loop, name='index-reconciler', daemon=True)
+    thread.start()
+    return thread
+
+
+def read_journal(since=0, limit=500):
+    """Index changes recorded after the given journal sequence number"""
+    rows = get_index_db().execute(
+        'SELECT * FROM journal WHERE seq > ? ORDER BY seq LIMIT ?', (since, limit))
+    return [dict(r) for r in rows]
+
+
+def get_indexed_videos(video_ids):
+    """Indexed videos for the given ids, in the given order"""
+    if not video_ids:
+        return []
+    placeholders = ','.join('?' * len(video_ids))
+    rows = get_index_db().execute(f'SELECT * FROM videos WHERE id IN ({placeholders})', list(video_ids))
+    by_id = {r['id']: video_row(r) for r in rows}
+    return [by_id[x] for x in video_ids if x in by_id]
+
 
-        if naref:
+def search_query(text):
+    """Turn free text into an FTS5 query that prefix-matches every word"""
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{w}"*' for w in words)
 
-            naref = naref.lstrip('/')
-            if naref.startswith('http'):
-                naref = '/' + naref
 
-            logger.debug('[%s] %s => %s' % (domain, aref, naref))
+def highlight_snippet(snippet):
+    """Escape an FTS snippet, then turn its match markers into <mark> tags"""
+    snippet = str(escape(snippet))
+    return Markup(snippet.replace('\x02', '<mark>').replace('\x03', '</mark>'))
 
-            if aref.startswith('/'):
-                html = html.replace('href="' + aref, 'href="' + naref)
-                html = html.replace('src="' + aref, 'src="' + naref)
+
+def encode_cursor(values):
+    """Opaque pagination cursor for the given keyset values"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Keyset values from a pagination cursor, or None if it is invalid"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        return None
+
+
+def query_library(sort='newest', after=None, limit=library_page_size, tags=(), categories=(), text=None):
+    """One page of indexed videos and the cursor for the next page.
+
+    Pages are fetched with keyset conditions on (sort key, id) so the cost of a
+    page does not depend on how deep into the library it is. Text searches
+    default to relevance order, which pages by offset into the ranked matches.
+    Only the search_rank_limit most recently indexed matches are ranked; older
+    matches follow them newest first, so every match can still be paged to.
+    """
+    cursor = decode_cursor(after) if after else None
+    below = None
+    if text and sort == 'relevance' and isinstance(cursor, dict) and isinstance(cursor.get('below'), int):
+        # Past the ranked matches: the rest of them, newest first
+        below, cursor, sort = cursor['below'], cursor.get('after'), 'newest'
+
+    select = 'SELECT videos.* FROM videos'
+    where = []
+    params = []
+
+    if text:
+        query = search_query(text)
+        if not query:
+            return [], None
+        # Only the page's ids are selected here; snippets are made for those rows alone
+        select = ('SELECT videos.rowid AS video_rowid, videos.id{score} '
+                  'FROM video_search JOIN videos ON videos.rowid = video_search.rowid')
+        where.append('video_search MATCH ?')
+        params.append(query)
+        if below is not None:
+            where.append('video_search.rowid < ?')
+            params.append(below)
+    elif sort == 'relevance':
+        sort = 'newest'
+
+    # Each selected tag/category narrows the result to the intersection
+    for kind, values in (('tag', tags), ('category', categories)):
+        for value in values:
+            where.append('videos.id IN (SELECT video_id FROM video_facets WHERE kind = ? AND value = ?)')
+            params += [kind, value]
+
+    conn = get_index_db()
+    rows = []
+    has_more = False
+    if sort == 'relevance':
+        offset = cursor if isinstance(cursor, int) and cursor > 0 else 0
+        # bm25 costs about as much as reading the match, so very common words
+        # only rank the most recently indexed search_rank_limit matches
+        # Weights: title, uploader, tags, categories, description, transcript
+        ranked = select.format(score=', bm25(video_search, 10.0, 4.0, 3.0, 2.0, 1.0, 1.0) AS score')
+        rows = conn.execute(
+            f'SELECT video_rowid, id FROM ({ranked} WHERE {" AND ".join(where)} '
+            f'ORDER BY video_search.rowid DESC LIMIT {search_rank_limit}) ORDER BY score, id LIMIT ? OFFSET ?',
+            params + [limit + 1, offset]).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if not has_more:
+            boundary = conn.execute(
+                f'SELECT video_search.rowid FROM video_search JOIN videos ON videos.rowid = video_search.rowid '
+                f'WHERE {" AND ".join(where)} ORDER BY video_search.rowid DESC LIMIT 1 OFFSET ?',
+                params + [search_rank_limit - 1]).fetchone()
+            if boundary is not None:
+                # The ranked set was cut off; fill the page from the unranked rest
+                below, cursor, sort = boundary[0], None, 'newest'
+                where.append('video_search.rowid < ?')
+                params.append(below)
+
+    keyset_rows = 0
+    if sort != 'relevance':
+        key, direction = LIBRARY_SORTS.get(sort, LIBRARY_SORTS['newest'])
+        if isinstance(cursor, list) and len(cursor) == 2:
+            op = '<' if direction == 'DESC' else '>'
+            # The leading single-column term lets SQLite seek on expression indexes
+            where.append(f'{key} {op}= ? AND ({key}, videos.id) {op} (?, ?)')
+            params += [cursor[0]] + cursor
+        sql = select.format(score='')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        count = limit - len(rows)
+        more = conn.execute(f'{sql} ORDER BY {key} {direction}, videos.id {direction} LIMIT ?',
+                            params + [count + 1]).fetchall()
+        has_more = len(more) > count
+        keyset_rows = len(more[:count])
+        rows += more[:count]
+
+    if text:
+        rows = search_page(conn, query, [(r[0], r[1]) for r in rows])
+    videos = [video_row(row) for row in rows]
+    for video in videos:
+        if 'snippet' in video:
+            video['snippet'] = highlight_snippet(video['snippet'])
+
+    next_cursor = None
+    if has_more and videos:
+        if sort == 'relevance':
+            next_cursor = encode_cursor(offset + limit)
+        else:
+            values = None
+            if keyset_rows:
+                last = videos[-1]
+                values = {
+                    'newest': last['timestamp'],
+                    'oldest': last['timestamp'],
+                    'title': last['title'] or '',
+                    'longest': last['duration'] or 0,
+                    'shortest': last['duration'] or 0,
+                }
+                values = [values.get(sort, last['timestamp']), last['id']]
+            next_cursor = encode_cursor(values if below is None else {'below': below, 'after': values})
+    return videos, next_cursor
+
+
+def search_page(conn, query, page):
+    """Index rows with match snippets for one page of (rowid, id) search results, in page order"""
+    rows = conn.execute(
+        "SELECT videos.*, snippet(video_search, -1, char(2), char(3), '…', 16) AS snippet "
+        'FROM video_search JOIN videos ON videos.rowid = video_search.rowid '
+        'WHERE video_search MATCH ? AND video_search.rowid IN (SELECT value FROM json_each(?))',
+        (query, json.dumps([rowid for rowid, _ in page]))).fetchall()
+    by_id = {row['id']: row for row in rows}
+    return [by_id[video_id] for _, video_id in page if video_id in by_id]
+
+
+def top_facets(kind, limit=facet_sidebar_size):
+    """The most used tags or categories with their video counts"""
+    rows = get_index_db().execute(
+        'SELECT value, count FROM facet_counts WHERE kind = ? ORDER BY count DESC, value LIMIT ?',
+        (kind, limit))
+    return [dict(r) for r in rows]
+
+
+def get_channel(channel_id):
+    """A channel's aggregates (name, video count, latest upload, duration, bytes), or None"""
+    row = get_index_db().execute('SELECT * FROM channels WHERE channel_id = ?', (channel_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_channel_videos(channel_id):
+    """Indexed videos for a channel, newest first"""
+    rows = get_index_db().execute(
+        'SELECT * FROM videos WHERE channel_id = ? ORDER BY timestamp DESC', (channel_id,))
+    return [video_row(r) for r in rows]
+
+
+@app.cli.command('migrate-cache')
+def migrate_cache_command():
+    """Convert legacy data.json files to summary.json plus compressed info.json.gz"""
+    migrated = 0
+    old_bytes = new_bytes = 0
+    old_read = new_read = 0.0
+    for vfile in glob.glob(f'{youtubecache}/*/data.json'):
+        try:
+            result = migrate_video_dir(os.path.dirname(vfile))
+        except Exception as e:
+            logger.warning(f'Could not migrate {vfile}: {e}')
+            continue
+        if result is None:
+            continue
+        migrated += 1
+        old_bytes += result[0]
+        new_bytes += result[1]
+        old_read += result[2]
+        new_read += result[3]
+
+    print(f'Migrated {migrated} videos')
+    if migrated:
+        print(f'Metadata on disk: {filesize_filter(old_bytes)} -> {filesize_filter(new_bytes)} '
+              f'({100 - 100 * new_bytes / max(old_bytes, 1):.0f}% smaller)')
+        print(f'Listing read time: {old_read:.2f}s -> {new_read:.2f}s')
+
+
+@app.cli.command('rebuild-index')
+def rebuild_index_command():
+    """Rebuild the youtube_cache metadata index from cached metadata files"""
+    count = rebuild_index()
+    print(f'Indexed {count} videos')
+
+
+_ytdl_pools = {}  # option set -> idle YoutubeDL instances
+_ytdl_pools_lock = threading.Lock()
+_ytdl_local = threading.local()
+
+
+def ytdl_progress(d):
+    """Forward yt-dlp progress to the callback registered for the current thread"""
+    callback = getattr(_ytdl_local, 'on_progress', None)
+    if callback is not None:
+        callback(d)
+
+
+YTDL_BASE_PARAMS = {'quiet': True, 'no_warnings': True, 'noprogress': True, 'progress_hooks': [ytdl_progress]}
+
+
+@contextmanager
+def ytdl(pooled=True, **params):
+    """Check out a warm yt_dlp.YoutubeDL configured with the given options.
+
+    Instances are kept per option set and reused, so extractor setup is paid
+    once per instance rather than once per call. YoutubeDL is not thread safe;
+    each instance is used by one thread at a time.
+    """
+    if not pooled:
+        with yt_dlp.YoutubeDL(dict(YTDL_BASE_PARAMS, **params)) as ydl:
+            yield ydl
+        return
+
+    key = json.dumps(params, sort_keys=True)
+    with _ytdl_pools_lock:
+        pool = _ytdl_pools.setdefault(key, queue.LifoQueue())
+    try:
+        ydl = pool.get_nowait()
+    except queue.Empty:
+        ydl = yt_dlp.YoutubeDL(dict(YTDL_BASE_PARAMS, **params))
+    try:
+        yield ydl
+    finally:
+        if pool.qsize() < ytdl_pool_size:
+            pool.put(ydl)
+        else:
+            ydl.close()
+
+
+def ytdl_extract(url, kind='metadata', **params):
+    """Metadata for a video, playlist or search URL, as `yt-dlp -J` would print it"""
+    with ytdl_timed(kind), ytdl(**params) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+
+def ytdl_search(query, count):
+    """Flat entries (id, title, ...) for the first results of a YouTube search"""
+    info = ytdl_extract(f'ytsearch{count}:{query}', 'search', extract_flat='in_playlist')
+    return [x for x in info.get('entries') or [] if x]
+
+
+def ytdl_playlist(url, playlist_end):
+    """Flat entries (id, title, ...) for the first videos of a playlist or channel"""
+    info = ytdl_extract(url, 'playlist', extract_flat='in_playlist', playlistend=playlist_end)
+    return [x for x in info.get('entries') or [] if x]
+
+
+def ytdl_subtitles(video_id):
+    """Write a video's English subtitles as <id>.en.vtt in its cache directory.
+
+    Uploaded subtitles are preferred; automatic captions are the fallback.
+    """
+    params = {
+        'skip_download': True,
+        'writesubtitles': True,
+        'writeautomaticsub': True,
+        'subtitleslangs': ['en'],
+        'subtitlesformat': 'vtt',
+        'outtmpl': os.path.join(youtubecache, '%(id)s', '%(id)s'),
+    }
+    with ytdl_timed('subtitles'), ytdl(**params) as ydl:
+        ydl.extract_info(video_id, download=True)
+
+
+def ytdl_download(video_id, format_id, path, on_progress=None):
+    """Download one format of a video to path, reporting progress to on_progress"""
+    _ytdl_local.on_progress = on_progress
+    try:
+        # Output path and format differ per call, so these instances are not pooled
+        with ytdl_timed('download'), ytdl(pooled=False, format=format_id, outtmpl=path, keepvideo=True) as ydl:
+            ydl.download([video_id])
+    finally:
+        _ytdl_local.on_progress = None
+
+
+class DownloadJob:
+    """A background yt-dlp download of one format of one video"""
+
+    def __init__(self, video_id, format_id, filename, total_bytes=None):
+        self.video_id = video_id
+        self.format_id = format_id
+        self.filename = filename
+        self.total_bytes = total_bytes
+        self.status = 'queued'
+        self.progress = 0.0
+        self.error = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            'video_id': self.video_id,
+            'format_id': self.format_id,
+            'filename': self.filename,
+            'status': self.status,
+            'progress': self.progress,
+            'total_bytes': self.total_bytes,
+            'error': self.error,
+        }
+
+
+download_jobs = {}  # (video_id, format_id) -> DownloadJob
+download_lock = threading.Lock()
+download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='download')
+
+
+def run_download(job):
+    """Run a download job through yt-dlp, tracking its progress"""
+    vdir = os.path.join(youtubecache, job.video_id)
+    path = os.path.join(vdir, job.filename)
+    logger.info(f'Downloading {job.video_id} format {job.format_id}')
+    job.status = 'downloading'
+
+    def on_progress(d):
+        if d.get('total_bytes'):
+            job.total_bytes = d['total_bytes']
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if d.get('status') == 'downloading' and total:
+            job.progress = 100.0 * d.get('downloaded_bytes', 0) / total
+
+    try:
+        # Another worker process may be downloading the same file; wait for it
+        # and pick up its result instead of writing the same .part file twice
+        with file_lock(f'download-{job.video_id}-{job.filename}'):
+            if not os.path.exists(path):
+                ytdl_download(job.video_id, job.format_id, path, on_progress)
+        if not os.path.exists(path):
+            job.status = 'failed'
+            job.error = 'yt-dlp finished without writing the file'
+        else:
+            job.status = 'done'
+            job.progress = 100.0
+            index_video_files(job.video_id)
+            enforce_media_quota()
+    except Exception as e:
+        logger.exception(e)
+        job.status = 'failed'
+        job.error = str(e)
+    finally:
+        job.finished_at = time.time()
+        job.done.set()
+
+
+def submit_download(video_id, format_id, filename, total_bytes=None):
+    """Queue a download, or join the one already running for this video and format"""
+    key = (video_id, format_id)
+    with download_lock:
+        # Forget jobs that finished more than an hour ago
+        for k, old in list(download_jobs.items()):
+            if old.finished_at and time.time() - old.finished_at > 3600:
+                del download_jobs[k]
+
+        job = download_jobs.get(key)
+        if job is not None and job.status != 'failed':
+            return job
+        job = DownloadJob(video_id, format_id, filename, total_bytes)
+        download_jobs[key] = job
+        publish_while_running(job, 'downloads', f'{video_id}_{format_id}')
+        download_pool.submit(run_download, job)
+        return job
+
+
+def find_download(video_id, filename):
+    """(total bytes, finished check) for a download still writing the given file,
+    in this or any other worker process; None if nothing is writing it"""
+    with download_lock:
+        for job in download_jobs.values():
+            if job.video_id == video_id and job.filename == filename and not job.done.is_set():
+                return job.total_bytes, job.done.is_set
+
+    # {video_id}_{format_id}, the key its job publishes under
+    key = os.path.splitext(filename)[0]
+
+    def finished():
+        state = shared_job('downloads', key)
+        return state is None or not state['active']
+
+    state = shared_job('downloads', key)
+    if state is not None and state['active']:
+        return state['total_bytes'], finished
+    if os.path.exists(os.path.join(youtubecache, video_id, filename + '.part')):
+        # Left by a download that's gone; serve what it wrote
+        return None, lambda: True
+    return None
+
+
+def stream_growing_file(path, start, end, finished):
+    """Yield bytes start..end of a file that a download job is still writing.
+
+    yt-dlp writes to path + '.part' and renames it when done; an open handle
+    keeps reading the same file across the rename. Reads that get ahead of
+    the download wait for more bytes, up to stream_wait_timeout.
+    """
+    part_path = path + '.part'
+    waited = 0.0
+    f = None
+    while f is None:
+        for candidate in (part_path, path):
+            try:
+                f = open(candidate, 'rb')
+                break
+            except FileNotFoundError:
+                continue
+        if f is None:
+            if finished() or waited >= stream_wait_timeout:
+                return
+            time.sleep(0.2)
+            waited += 0.2
+
+    with f:
+        f.seek(start)
+        pos = start
+        waited = 0.0
+        while end is None or pos <= end:
+            want = stream_chunk_size if end is None else min(stream_chunk_size, end - pos + 1)
+            chunk = f.read(want)
+            if chunk:
+                pos += len(chunk)
+                waited = 0.0
+                yield chunk
+                continue
+            if finished():
+                # One last read in case the final bytes landed after the check
+                chunk = f.read(want)
+                if not chunk:
+                    return
+                pos += len(chunk)
+                yield chunk
+                continue
+            if waited >= stream_wait_timeout:
+                logger.warning(f'Gave up waiting for {path} at byte {pos}')
+                return
+            time.sleep(0.2)
+            waited += 0.2
+
+
+def serve_growing_file(path, total, finished):
+    """Respond with a file that is still downloading, honoring Range requests"""
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if not total:
+        # Without a known length the bytes can only be streamed from the start
+        return Response(stream_growing_file(path, 0, None, finished), mimetype=mimetype,
+                        headers={'Accept-Ranges': 'none', 'Cache-Control': 'no-store'})
+
+    start, end = 0, total - 1
+    status = 200
+    match = re.match(r'bytes=(\d*)-(\d*)$', request.headers.get('Range', ''))
+    if match and (match.group(1) or match.group(2)):
+        if match.group(1):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), total - 1)
+        else:
+            start = max(total - int(match.group(2)), 0)
+        if start > end:
+            return Response(status=416, headers={'Content-Range': f'bytes */{total}'})
+        status = 206
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(end - start + 1),
+        'Cache-Control': 'no-store',
+    }
+    if status == 206:
+        headers['Content-Range'] = f'bytes {start}-{end}/{total}'
+    return Response(stream_growing_file(path, start, end, finished), status=status,
+                    mimetype=mimetype, headers=headers)
+
+
+def is_media_file(video_id, filename):
+    """Downloaded formats are named {video_id}_{format_id}.{ext}; transcripts,
+    subtitles, metadata and unfinished downloads never match"""
+    return filename.startswith(video_id + '_') and not filename.endswith(('.part', '.tmp', '.ytdl'))
+
+
+_media_touched = {}  # (video_id, filename) -> when this process last recorded an access
+
+
+def record_media_access(video_id, filename):
+    """Note that a media file was watched; throttled so range requests don't each write"""
+    key = (video_id, filename)
+    now = time.time()
+    if now - _media_touched.get(key, 0) < media_access_interval:
+        return
+    _media_touched[key] = now
+    conn = get_index_db()
+    with conn:
+        conn.execute('INSERT INTO media_access (video_id, filename, last_access, hits) VALUES (?, ?, ?, 1) '
+                     'ON CONFLICT (video_id, filename) DO UPDATE SET last_access = excluded.last_access, '
+                     'hits = hits + 1', (video_id, filename, now))
+
+
+def media_excess_bytes():
+    """How many bytes youtube_cache is over its quota or under the free-space floor"""
+    excess = 0
+    if media_quota_bytes:
+        total = get_index_db().execute('SELECT COALESCE(SUM(bytes), 0) FROM videos').fetchone()[0]
+        excess = total - media_quota_bytes
+    if media_min_free_bytes:
+        excess = max(excess, media_min_free_bytes - shutil.disk_usage(youtubecache).free)
+    return excess
+
+
+def eviction_candidates():
+    """Media files that may be evicted, least valuable first.
+
+    Videos that are favorited, from a favorited channel, or downloading are
+    kept. Files never watched count as accessed when they were downloaded.
+    """
+    conn = get_index_db()
+    favs = favorites_store.to_dict()
+    keep = set(favs['videos'])
+    favorite_channels = {c['id'] for c in favs['channels']}
+    with download_lock:
+        keep.update(job.video_id for job in download_jobs.values() if job.finished_at is None)
+    keep.update(state['video_id'] for state in shared_jobs('downloads') if state['active'])
+    access = {(r['video_id'], r['filename']): (r['last_access'], r['hits'])
+              for r in conn.execute('SELECT * FROM media_access')}
+
+    candidates = []
+    for row in conn.execute("SELECT id, channel_id, files FROM videos WHERE files != '[]'"):
+        if row['id'] in keep or row['channel_id'] in favorite_channels:
+            continue
+        for filename in json.loads(row['files']):
+            if not is_media_file(row['id'], filename):
+                continue
+            try:
+                st = os.stat(os.path.join(youtubecache, row['id'], filename))
+            except FileNotFoundError:
+                continue
+            last_access, hits = access.get((row['id'], filename), (st.st_mtime, 0))
+            candidates.append({'video_id': row['id'], 'filename': filename, 'bytes': st.st_size,
+                               'last_access': last_access, 'hits': hits})
+
+    if media_eviction == 'lfu':
+        candidates.sort(key=lambda c: (c['hits'], c['last_access']))
+    else:
+        candidates.sort(key=lambda c: c['last_access'])
+    return candidates
+
+
+def enforce_media_quota():
+    """Evict media files until youtube_cache is back within its limits; returns bytes freed"""
+    with file_lock('media-quota', blocking=False) as held:
+        if not held:
+            return 0
+        excess = media_excess_bytes()
+        if excess <= 0:
+            return 0
+
+        freed = 0
+        evicted = []
+        for c in eviction_candidates():
+            if freed >= excess:
+                break
+            try:
+                os.remove(os.path.join(youtubecache, c['video_id'], c['filename']))
+            except FileNotFoundError:
+                continue
+            freed += c['bytes']
+            evicted.append(c)
+
+        conn = get_index_db()
+        with conn:
+            conn.executemany('DELETE FROM media_access WHERE video_id = ? AND filename = ?',
+                             [(c['video_id'], c['filename']) for c in evicted])
+        for video_id in {c['video_id'] for c in evicted}:
+            index_video_files(video_id)
+        if freed < excess:
+            logger.warning(f'youtube_cache still {excess - freed} bytes over its limits; '
+                           'the rest is favorites, downloads in progress and metadata')
+        logger.info(f'Evicted {len(evicted)} media files ({freed} bytes, {media_eviction})')
+        return freed
+
+
+def media_usage(limit=50):
+    """Disk usage of youtube_cache against its limits, with the channels using the most space"""
+    conn = get_index_db()
+    channels = conn.execute('SELECT * FROM channels WHERE total_bytes > 0 ORDER BY total_bytes DESC LIMIT ?',
+                            (limit,))
+    return {
+        'bytes': conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM videos').fetchone()[0],
+        'quota': media_quota_bytes,
+        'free': shutil.disk_usage(youtubecache).free,
+        'min_free': media_min_free_bytes,
+        'eviction': media_eviction,
+        'channels': [dict(r) for r in channels],
+    }
+
+
+@app.route('/youtube/jobs')
+def youtube_jobs():
+    """Status of all known download jobs, in every worker process"""
+    return jsonify(shared_jobs('downloads'))
+
+
+@app.route('/youtube/jobs/<video_id>/<format_id>')
+def youtube_job(video_id, format_id):
+    """Status and progress of one download job"""
+    with download_lock:
+        job = download_jobs.get((video_id, format_id))
+    if job is not None:
+        return jsonify(job.to_dict())
+    # Started by another worker process
+    state = shared_job('downloads', f'{video_id}_{format_id}')
+    if state is None:
+        return jsonify({'video_id': video_id, 'format_id': format_id, 'status': 'unknown'}), 404
+    return jsonify(state)
+
+
+URL_ATTRS = ('href', 'src', 'action', 'formaction', 'poster')
+RAW_TEXT_END = {tag: re.compile('</' + tag, re.I) for tag in ('script', 'style')}
+MARKUP_RE = re.compile(r'<(?:[a-zA-Z]|!--)')
+TAG_RE = re.compile(r'''<([a-zA-Z][^\s/>"']*)[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>''')
+PARTIAL_TAG_RE = re.compile(r'''<[a-zA-Z][^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*(?:"[^"]*|'[^']*)?\Z''')
+ATTR_RE = re.compile(r'''(\s+)([^\s"'>/=]+)(?:(\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+))?''')
+SCHEME_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:')
+
+
+def proxy_url(url):
+    """Map an absolute http(s) url to the proxy's /http.host/path form"""
+    if url.startswith('https://'):
+        return '/https.' + url[len('https://'):]
+    if url.startswith('http://'):
+        return '/http.' + url[len('http://'):]
+    return None
+
+
+class UrlRewriter:
+    """Single-pass rewriter for link attributes in HTML fed in arbitrary chunks"""
+
+    def __init__(self, base_url):
+        self.set_base(base_url)
+        self.buffer = ''
+        self.raw_tag = None  # inside <script>/<style>, where markup isn't parsed
+        self.links = 0
+        self.video_ids = []  # YouTube videos linked from the page, for read-ahead
+
+    def set_base(self, base_url):
+        o = urlparse(base_url)
+        self.base_url = base_url
+        self.scheme = o.scheme or 'http'
+        self.origin = f'{self.scheme}://{o.netloc}'
+        self.directory = self.origin + o.path[:o.path.rfind('/') + 1] if '/' in o.path else self.origin + '/'
+
+    def resolve(self, url):
+        """Proxy form of a link on the page; urljoin only for the uncommon relative forms"""
+        value = url.strip()
+        if not value or value[0] == '#':
+            return url
+        if value.startswith(('https://', 'http://')):
+            absolute = value
+        elif value[0] == '/':
+            absolute = self.scheme + ':' + value if value.startswith('//') else self.origin + value
+        elif value[0] in '.?' or SCHEME_RE.match(value):
+            absolute = urljoin(self.base_url, value)
+        else:
+            absolute = self.directory + value
+        self.links += 1
+        if 'youtu' in absolute:
+            video_id = youtube_video_id(absolute)
+            if video_id:
+                self.video_ids.append(video_id)
+        return proxy_url(absolute) or url  # mailto:, javascript:, data: and friends stay as they are
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        return self._rewrite(final=False)
+
+    def close(self):
+        return self._rewrite(final=True)
+
+    def _rewrite(self, final):
+        buf = self.buffer
+        out = []
+        pos = 0
+        while pos < len(buf):
+            if self.raw_tag:
+                m = RAW_TEXT_END[self.raw_tag].search(buf, pos)
+                if m is None:
+                    # hold back enough to recognise a closing tag split across chunks
+                    keep = len(buf) if final else max(pos, len(buf) - len(self.raw_tag) - 2)
+                    out.append(buf[pos:keep])
+                    pos = keep
+                    break
+                out.append(buf[pos:m.start()])
+                pos = m.start()
+                self.raw_tag = None
+                continue
+
+            m = MARKUP_RE.search(buf, pos)
+            if m is None:
+                keep = len(buf)
+                if not final:
+                    # a '<', '<!' or '<!-' at the very end may start a tag or comment
+                    tail = buf.rfind('<', max(pos, len(buf) - 3))
+                    if tail >= 0 and '<!--'.startswith(buf[tail:]):
+                        keep = tail
+                out.append(buf[pos:keep])
+                pos = keep
+                break
+            lt = m.start()
+            out.append(buf[pos:lt])
+            pos = lt
+
+            if buf.startswith('<!--', lt):
+                end = buf.find('-->', lt + 4)
+                if end < 0:
+                    if final:
+                        out.append(buf[lt:])
+                        pos = len(buf)
+                    break
+                out.append(buf[lt:end + 3])
+                pos = end + 3
+                continue
+
+            m = TAG_RE.match(buf, lt)
+            if m is None:
+                if not final and PARTIAL_TAG_RE.match(buf, lt):
+                    break  # the rest of this tag is still upstream
+                out.append('<')
+                pos = lt + 1
+                continue
+
+            name = m.group(1).lower()
+            out.append(self._rewrite_tag(m.group(0), name))
+            pos = m.end()
+            if name in RAW_TEXT_END and not m.group(0).endswith('/>'):
+                self.raw_tag = name
+
+        self.buffer = buf[pos:]
+        return ''.join(out)
+
+    def _rewrite_tag(self, tag, name):
+        if '=' not in tag:
+            return tag
+
+        def attr(m):
+            space, key, equals, value = m.groups()
+            key_lower = key.lower()
+            if value is None or (key_lower not in URL_ATTRS and key_lower != 'srcset'):
+                return m.group(0)
+            quote = value[0] if value[0] in '"\'' else ''
+            raw = value[1:-1] if quote else value
+            if key_lower == 'srcset':
+                rewritten = ', '.join(self._rewrite_candidate(c) for c in raw.split(',') if c.strip())
             else:
-                html = html.replace('href="' + aref, 'href="' + naref)
-                html = html.replace('src="' + aref, 'src="' + naref)
+                rewritten = self.resolve(raw)
+                if name == 'base' and key_lower == 'href':
+                    self.set_base(urljoin(self.base_url, raw.strip()))
+            return f'{space}{key}{equals}{quote}{rewritten}{quote}'
+
+        return tag[:len(name) + 1] + ATTR_RE.sub(attr, tag[len(name) + 1:])
+
+    def _rewrite_candidate(self, candidate):
+        url, *descriptor = candidate.split()
+        return ' '.join([self.resolve(url)] + descriptor)
 
-            html = html.replace('="' + aref, '="' + naref)
 
-    html = html.replace('="https://', '="/https.')
-    html = html.replace('="http://', '="/http.')
+def rewrite_urls(html, base_url):
+    """Rewrite every link on a complete upstream page to go through the proxy"""
+    rewriter = UrlRewriter(base_url)
+    return rewriter.feed(html) + rewriter.close()
 
-    return html
+
+def upstream_headers(rr, names=PROXY_HEADERS):
+    """Headers relayed from an upstream response, with a redirect's Location sent back through the proxy"""
+    headers = {k: rr.headers[k] for k in names if k in rr.headers}
+    if rr.is_redirect:
+        location = rr.headers['Location']
+        headers['Location'] = proxy_url(urljoin(rr.url, location)) or location
+    return headers
+
+
+def proxy_stream(rr):
+    """Relay a non-HTML upstream response to the client chunk by chunk"""
+    headers = upstream_headers(rr)
+    # iter_content decodes gzip/deflate, so the upstream length only holds for identity bodies
+    if 'Content-Length' in rr.headers and not rr.headers.get('Content-Encoding'):
+        headers['Content-Length'] = rr.headers['Content-Length']
+    logger.info(f"streaming {headers.get('Content-Type', 'unknown type')} from {rr.url}")
+
+    def generate():
+        try:
+            for chunk in rr.iter_content(stream_chunk_size):
+                yield chunk
+        finally:
+            rr.close()
+
+    return Response(generate(), status=rr.status_code, headers=headers, direct_passthrough=True)
+
+
+# Rewritten pages, gzipped, keyed by (final url, upstream validator) so a repeat
+# view of an unchanged page skips fetching the body and rewriting it.
+rewrite_cache = OrderedDict()
+rewrite_cache_lock = threading.Lock()
+rewrite_cache_stats = {'hits': 0, 'misses': 0, 'bytes': 0}
+
+
+def rewrite_cache_key(rr):
+    """ETag/Last-Modified identify the upstream body; a requests_cache copy is its own version.
+
+    Only 200 pages are cached, since a cached body is always served as a 200.
+    """
+    if rr.status_code != 200:
+        return None
+    validator = rr.headers.get('ETag') or rr.headers.get('Last-Modified')
+    if not validator and getattr(rr, 'from_cache', False):
+        validator = f'{rr.cache_key}@{rr.created_at.isoformat()}'
+    return (rr.url, validator) if validator else None
+
+
+def rewrite_cache_get(key):
+    with rewrite_cache_lock:
+        body = rewrite_cache.get(key) if key else None
+        if body is None:
+            rewrite_cache_stats['misses'] += 1
+            rewrite_cache_requests.inc('miss')
+            return None
+        rewrite_cache.move_to_end(key)
+        rewrite_cache_stats['hits'] += 1
+        rewrite_cache_requests.inc('hit')
+        return body
+
+
+def rewrite_cache_put(key, html):
+    body = gzip.compress(html.encode('utf-8'), compresslevel=6)
+    if len(body) > rewrite_cache_max_bytes // 8:
+        return
+    with rewrite_cache_lock:
+        old = rewrite_cache.pop(key, None)
+        if old is not None:
+            rewrite_cache_stats['bytes'] -= len(old)
+        rewrite_cache[key] = body
+        rewrite_cache_stats['bytes'] += len(body)
+        while rewrite_cache_stats['bytes'] > rewrite_cache_max_bytes:
+            _, evicted = rewrite_cache.popitem(last=False)
+            rewrite_cache_stats['bytes'] -= len(evicted)
+
+
+def rewrite_cache_clear(match=None):
+    with rewrite_cache_lock:
+        for key in [key for key in rewrite_cache if match is None or match(key[0])]:
+            rewrite_cache_stats['bytes'] -= len(rewrite_cache.pop(key))
+
+
+def rewritten_response(body, headers=None):
+    """Serve a cached rewritten page, still gzipped if the client accepts it"""
+    headers = dict(headers or {})
+    if request.accept_encodings['gzip']:
+        headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        return Response(body, content_type='text/html; charset=utf-8', headers=headers)
+    return Response(gzip.decompress(body), content_type='text/html; charset=utf-8', headers=headers)
+
+
+def rewrite_stream(rr, cache_key=None, web_cache_key=None):
+    """Rewrite an upstream HTML page as it arrives instead of after it's fully read.
+
+    With a web_cache_key, the page came from upstream_session and is added to
+    the web cache once all of it has been read.
+    """
+    rewriter = UrlRewriter(rr.url)
+    decoder = codecs.getincrementaldecoder(rr.encoding or 'utf-8')(errors='replace')
+    body = []
+    parts = []
+    elapsed = 0.0  # rewriting only, not waiting on upstream or the client
+    try:
+        for chunk in rr.iter_content(stream_chunk_size):
+            if web_cache_key:
+                body.append(chunk)
+            start = time.perf_counter()
+            parts.append(rewriter.feed(decoder.decode(chunk)))
+            elapsed += time.perf_counter() - start
+            yield parts[-1]
+        start = time.perf_counter()
+        parts.append(rewriter.feed(decoder.decode(b'', final=True)) + rewriter.close())
+        elapsed += time.perf_counter() - start
+        yield parts[-1]
+    finally:
+        rr.close()
+    rewrite_seconds.observe(elapsed)
+    if web_cache_key:
+        rr._content = b''.join(body)
+        save_streamed_response(rr, web_cache_key)
+    if cache_key:
+        rewrite_cache_put(cache_key, ''.join(parts))
+    logger.debug(f'rewrote {rewriter.links} urls on {rr.url}')
+    readahead(rewriter.video_ids)
+
+
+def save_streamed_response(rr, cache_key):
+    """Cache a response fetched with upstream_session the way requests_cache would have"""
+    if rr.status_code in session.settings.allowable_codes and cacheable_response(rr):
+        web_cache.save_response(rr, cache_key)
+
+
+def web_cache_result(rr):
+    """hit, stale (served expired while a background request refreshes it), revalidated or miss"""
+    if not getattr(rr, 'from_cache', False):
+        return 'miss'
+    if getattr(rr, 'revalidated', False):
+        return 'revalidated'
+    return 'stale' if rr.is_expired else 'hit'
 
 
 def do_link(path):
 
-    protocol = None
     domain = None
     url = path.lstrip('/')
     if url.startswith('http.'):
         url = url.replace('http.', 'http://')
         o = urlparse(url)
         domain = o.netloc
-        protocol = 'http'
     elif url.startswith('https.'):
         url = url.replace('https.', 'https://')
         o = urlparse(url)
         domain = o.netloc
-        protocol = 'https'
 
     elif url.startswith('www') and not domain:
         if '/' in url:
@@ -129,48 +2133,162 @@ def do_link(path):
         url = 'http://' + url
 
     logger.info('get %s' % url)
-    rr = session.get(url, headers=headers, verify=False)
-    thishtml = rr.text
-    logger.info('replacing urls (domain=%s)' % domain)
-    thishtml = replace_urls(thishtml, domain, protocol=protocol)
-    return thishtml
+    start = time.perf_counter()
+    # Responses already in the web cache come through requests_cache; the rest
+    # are streamed from upstream and cached once they have been read
+    web_cache_key = web_cache.create_key(requests.Request('GET', url, headers=headers), verify=False)
+    missed = not web_cache.contains(key=web_cache_key)
+    try:
+        rr = (upstream_session if missed else session).get(url, headers=headers, verify=False, stream=True,
+                                                          timeout=upstream_timeout)
+    except requests.exceptions.Timeout:
+        logger.warning(f'upstream timed out: {url}')
+        upstream_seconds.observe(time.perf_counter() - start, 'error')
+        return f'Upstream timed out: {url}', 504
+    except requests.exceptions.ConnectionError as e:
+        logger.warning(f'upstream unreachable: {url} ({e})')
+        upstream_seconds.observe(time.perf_counter() - start, 'error')
+        return f'Could not reach upstream: {url}', 502
+    result = web_cache_result(rr)
+    web_cache_requests.inc(result)
+    upstream_seconds.observe(time.perf_counter() - start, result)
+    if not is_html(rr.headers.get('Content-Type')):
+        if missed and cacheable_response(rr):
+            rr.content  # small enough to buffer before relaying
+            save_streamed_response(rr, web_cache_key)
+        return proxy_stream(rr)
+    cache_key = rewrite_cache_key(rr)
+    body = rewrite_cache_get(cache_key)
+    if body is not None:
+        rr.close()
+        logger.info('serving rewritten page from cache (domain=%s)' % domain)
+        return rewritten_response(body, upstream_headers(rr, REWRITTEN_HEADERS))
+    logger.info('rewriting urls (domain=%s)' % domain)
+    return Response(rewrite_stream(rr, cache_key, web_cache_key if missed else None), status=rr.status_code,
+                    headers=upstream_headers(rr, REWRITTEN_HEADERS), content_type='text/html; charset=utf-8')
+
+
+@app.route('/proxy/cache/stats')
+def proxy_cache_stats():
+    """Hit/miss counts and size of the rewritten page cache"""
+    with rewrite_cache_lock:
+        stats = dict(rewrite_cache_stats, entries=len(rewrite_cache), max_bytes=rewrite_cache_max_bytes)
+    return jsonify(stats)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    """Observe the request once its body has been sent, so streamed pages and videos count in full"""
+    start = g.get('request_start')
+    if start is not None:
+        labels = (request.url_rule.rule if request.url_rule else 'unmatched', request.method,
+                  str(response.status_code))
+        response.call_on_close(lambda: request_seconds.observe(time.perf_counter() - start, *labels))
+    return response
+
+
+def metrics_gauges():
+    """(name, help, value) for sizes read from the caches at scrape time"""
+    conn = get_index_db()
+    cache_bytes, video_count = conn.execute('SELECT COALESCE(SUM(bytes), 0), COUNT(*) FROM videos').fetchone()
+    web = web_cache.stats()
+    with rewrite_cache_lock:
+        rewrite_bytes, rewrite_entries = rewrite_cache_stats['bytes'], len(rewrite_cache)
+    return [
+        ('adhdproxy_youtube_cache_bytes', 'Bytes of the video directories in youtube_cache: media, metadata, '
+         'thumbnails and transcripts', cache_bytes),
+        ('adhdproxy_youtube_cache_videos', 'Videos in the metadata index', video_count),
+        ('adhdproxy_web_cache_bytes', 'Bytes of responses in the web cache', web['bytes']),
+        ('adhdproxy_web_cache_entries', 'Responses in the web cache', web['entries']),
+        ('adhdproxy_rewrite_cache_bytes', 'Bytes of rewritten pages cached by this process', rewrite_bytes),
+        ('adhdproxy_rewrite_cache_entries', 'Rewritten pages cached by this process', rewrite_entries),
+    ]
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request latency, cache and yt-dlp metrics in the Prometheus text format"""
+    lines = []
+    for name, values in collect_metrics().items():
+        m = metrics[name]
+        lines += [f'# HELP {name} {m.doc}', f'# TYPE {name} {m.kind}']
+        for labels, value in sorted(values.items()):
+            if not m.buckets:
+                lines.append(f'{name}{format_labels(m.labels, labels)} {value}')
+                continue
+            for bound, n in zip(m.buckets + ('+Inf',), value[:-2] + [value[-1]]):
+                lines.append(f'{name}_bucket{format_labels(m.labels, labels, le=bound)} {n}')
+            lines.append(f'{name}_sum{format_labels(m.labels, labels)} {value[-2]}')
+            lines.append(f'{name}_count{format_labels(m.labels, labels)} {value[-1]}')
+    for name, doc, value in metrics_gauges():
+        lines += [f'# HELP {name} {doc}', f'# TYPE {name} gauge', f'{name} {value}']
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def metrics_summary():
+    """The metrics the controls page shows: per route, per cache outcome and per yt-dlp kind"""
+    collected = collect_metrics()
+
+    def timings(name, key):
+        m = metrics[name]
+        rows = {}
+        for labels, value in collected[name].items():
+            row = rows.setdefault(key(labels), [0] * len(m.buckets) + [0.0, 0])
+            rows[key(labels)] = [a + b for a, b in zip(row, value)]
+        return [{'name': k, 'count': v[-1], 'avg': v[-2] / v[-1], 'p95': histogram_quantile(v, m.buckets, 0.95)}
+                for k, v in sorted(rows.items(), key=lambda kv: -kv[1][-2]) if v[-1]]
+
+    def outcomes(name):
+        values = {labels[0]: n for labels, n in collected[name].items()}
+        return {'counts': values, 'total': sum(values.values())}
+
+    ytdl = timings('adhdproxy_ytdl_seconds', lambda labels: labels[0])
+    errors = {labels[0]: n for labels, n in collected['adhdproxy_ytdl_errors_total'].items()}
+    for row in ytdl:
+        row['errors'] = errors.get(row['name'], 0)
+    return {
+        'routes': timings('adhdproxy_request_duration_seconds', lambda labels: f'{labels[1]} {labels[0]}'),
+        'fetch': (timings('adhdproxy_upstream_seconds', lambda labels: f'upstream fetch ({labels[0]})') +
+                  timings('adhdproxy_rewrite_seconds', lambda labels: 'link rewriting')),
+        'web_cache': outcomes('adhdproxy_web_cache_requests_total'),
+        'rewrite_cache': outcomes('adhdproxy_rewrite_cache_requests_total'),
+        'ytdl': ytdl,
+    }
+
+
+@app.route('/youtube/index/journal')
+def youtube_index_journal():
+    """Changes to the metadata index since a journal sequence number"""
+    since = request.args.get('since', 0, type=int)
+    return jsonify(read_journal(since))
 
 
 @app.route('/files/youtube/<path:path>')
 def files_youtube(path):
     fn = os.path.join(youtubecache, path)
+    video_id, _, filename = path.partition('/')
+    if is_media_file(video_id, filename):
+        record_media_access(video_id, filename)
+    if not os.path.exists(fn):
+        # Serve downloads in progress, whichever worker runs them, while they are still being written
+        download = find_download(video_id, filename)
+        if download is not None:
+            return serve_growing_file(fn, *download)
     return send_file(fn)
 
 
 @app.route('/favorites')
 def favorites():
     """Show favorites page"""
-    favs = load_favorites()
+    favs = favorites_store.to_dict()
 
     # Load details for favorite videos
-    video_details = []
-    for video_id in favs.get('videos', []):
-        vdir = os.path.join(youtubecache, video_id)
-        df = os.path.join(vdir, 'data.json')
-        if os.path.exists(df):
-            try:
-                with open(df, 'r') as f:
-                    ds = json.loads(f.read())
-
-                    # Skip if data is invalid
-                    if not ds or not isinstance(ds, dict) or 'id' not in ds:
-                        logger.warning(f'Skipping invalid data file: {df}')
-                        continue
-
-                    video_details.append({
-                        'id': ds['id'],
-                        'title': ds['title'],
-                        'uploader': ds.get('uploader'),
-                        'channel_id': ds.get('channel_id'),
-                        'upload_date': ds.get('upload_date')
-                    })
-            except Exception as e:
-                logger.exception(e)
+    video_details = get_indexed_videos(favs.get('videos', []))
 
     # Load details for favorite channels
     channel_details = []
@@ -179,28 +2297,34 @@ def favorites():
 
     return render_template('favorites.html',
                          videos=video_details,
-                         channels=channel_details)
+                         channels=channel_details,
+                         refresh=shared_job('refresh', 'favorites'))
+
+
+@app.route('/favorites/refresh', methods=['POST'])
+def favorites_refresh_start():
+    """Fetch the latest uploads of every favorite channel in the background"""
+    start_favorites_refresh()
+    return redirect('/favorites')
+
+
+@app.route('/favorites/refresh.json')
+def favorites_refresh_status():
+    """Progress of the latest favorites refresh, whichever worker ran it"""
+    return jsonify(shared_job('refresh', 'favorites') or {'status': 'idle'})
 
 
 @app.route('/favorite/add', methods=['POST'])
 def add_favorite():
     """Add a video or channel to favorites"""
-    favs = load_favorites()
-
     item_type = request.form.get('type')  # 'video' or 'channel'
     item_id = request.form.get('id')
 
     if item_type == 'video':
-        if item_id not in favs['videos']:
-            favs['videos'].append(item_id)
+        favorites_store.add_video(item_id)
     elif item_type == 'channel':
-        channel_name = request.form.get('name')
-        # Check if channel already exists
-        existing = [c for c in favs['channels'] if c['id'] == item_id]
-        if not existing:
-            favs['channels'].append({'id': item_id, 'name': channel_name})
-
-    save_favorites(favs)
+        favorites_store.add_channel(item_id, request.form.get('name'))
+    favorites_store.flush()
 
     # Redirect back to referrer or favorites page
     return_url = request.form.get('return_url', '/favorites')
@@ -210,23 +2334,265 @@ def add_favorite():
 @app.route('/favorite/remove', methods=['POST'])
 def remove_favorite():
     """Remove a video or channel from favorites"""
-    favs = load_favorites()
-
     item_type = request.form.get('type')  # 'video' or 'channel'
     item_id = request.form.get('id')
 
-    if item_type == 'video' and item_id in favs['videos']:
-        favs['videos'].remove(item_id)
+    if item_type == 'video':
+        favorites_store.remove_videos(item_id)
     elif item_type == 'channel':
-        favs['channels'] = [c for c in favs['channels'] if c['id'] != item_id]
-
-    save_favorites(favs)
+        favorites_store.remove_channel(item_id)
+    favorites_store.flush()
 
     # Redirect back to referrer or favorites page
     return_url = request.form.get('return_url', '/favorites')
     return redirect(return_url)
 
 
+VTT_TIMING_RE = re.compile(r'(?:(\d+):)?(\d{2}):(\d{2})\.(\d{3})\s+-->')
+VTT_TAG_RE = re.compile(r'<[^>]*>')
+VTT_TIMESTAMP_TAG_RE = re.compile(r'<(?:\d+:)?\d{2}:\d{2}\.\d{3}>')
+SENTENCE_END_RE = re.compile(r'([.?!])\s+')
+
+
+def parse_vtt(lines):
+    """Yield (start seconds, text) for each new caption line of a WebVTT file, in one pass.
+
+    YouTube's automatic captions roll: each cue repeats the line shown before
+    it and adds the next one, with a brief cue in between that shows only the
+    finished line. Lines the previous cue already showed are skipped, so each
+    spoken line comes out once, timed by the cue it first appears in. Only
+    automatic captions, recognised by their align:start cue settings or inline
+    timing tags, are deduplicated: in manual subtitles a line repeated in
+    consecutive cues was said twice.
+    """
+    start = None
+    previous = set()
+    current = set()
+    in_cue = False
+    rolling = False
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:  # YouTube pads cues with lines of a single space; only truly empty lines end a cue
+            if in_cue:
+                previous = current
+                in_cue = False
+            continue
+        line = line.strip()
+        m = VTT_TIMING_RE.match(line)
+        if m:
+            hours, minutes, seconds, millis = m.groups()
+            start = int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000
+            current = set()
+            in_cue = True
+            rolling = rolling or 'align:start' in line[m.end():]
+            continue
+        if not in_cue:
+            continue  # header, NOTE/STYLE blocks and cue identifiers
+        rolling = rolling or bool(VTT_TIMESTAMP_TAG_RE.search(line))
+        text = VTT_TAG_RE.sub('', line).strip()
+        if not text:
+            continue
+        if not rolling:
+            yield start, text
+        elif text not in current:
+            current.add(text)
+            if text not in previous:
+                yield start, text
+
+
+def write_transcript(cues, f):
+    """Write caption lines as plain text, one sentence per line"""
+    separator = ''
+    for _, text in cues:
+        text = SENTENCE_END_RE.sub('\\1\n', text)
+        f.write(separator + text)
+        separator = '\n' if text[-1] in '.?!' else ' '
+    if separator:
+        f.write('\n')
+
+
+def save_transcript(video_id, vtt_file):
+    """Convert a downloaded VTT file to the video's transcript.txt, plus its cue times for paging"""
+    vdir = os.path.join(youtubecache, video_id)
+    transcript_file = os.path.join(vdir, 'transcript.txt')
+    cues_file = os.path.join(vdir, 'transcript.cues.tsv')
+    tmp_file = tmp_name(transcript_file)
+    tmp_cues = tmp_name(cues_file)
+
+    with open(vtt_file, 'r', encoding='utf-8') as src, \
+            open(tmp_file, 'w', encoding='utf-8') as dst, \
+            open(tmp_cues, 'w', encoding='utf-8') as cues:
+
+        def timed_lines():
+            for start, text in parse_vtt(src):
+                cues.write(f'{start:.3f}\t{text}\n')
+                yield start, text
+
+        write_transcript(timed_lines(), dst)
+    os.replace(tmp_cues, cues_file)
+    os.replace(tmp_file, transcript_file)
+    index_video_files(video_id)
+    logger.info(f'Transcript saved: {transcript_file}')
+
+
+def fetch_video_transcript(video_id):
+    """Download a video's English subtitles and save them as transcript.txt; returns whether there were any"""
+    vdir = os.path.join(youtubecache, video_id)
+    os.makedirs(vdir, exist_ok=True)
+    logger.info(f'Fetching transcript: {video_id}')
+    throttled('www.youtube.com', ytdl_subtitles, video_id)
+    vtt_files = sorted(glob.glob(f'{vdir}/*.vtt'))
+    if not vtt_files:
+        logger.warning(f'No transcript available for {video_id}')
+        return False
+    save_transcript(video_id, vtt_files[0])
+    return True
+
+
+def has_transcript(video_id):
+    return os.path.exists(os.path.join(youtubecache, video_id, 'transcript.txt'))
+
+
+def line_start(f, offset):
+    """The offset of the first line of a binary file starting at or after offset"""
+    if offset <= 0:
+        return 0
+    f.seek(offset - 1)
+    f.readline()
+    return f.tell()
+
+
+def cue_offset(f, start):
+    """The offset of the first cue at or after start seconds, by binary search over the cue file"""
+    lo, hi = 0, os.fstat(f.fileno()).st_size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line_start(f, mid)
+        line = f.readline()
+        if not line or float(line.split(b'\t', 1)[0]) >= start:
+            hi = mid
+        else:
+            lo = mid + 1
+    return line_start(f, lo)
+
+
+def transcript_page(video_id, offset=0, start=None):
+    """About transcript_page_bytes of a cached transcript, from a byte offset or a start time.
+
+    Reads transcript.cues.tsv (cue start seconds, tab, text), or for
+    transcripts saved before cue times were kept, transcript.txt without
+    times. Returns the cues and the offset of the next page, or None at
+    the end, so a page costs the same however long the transcript is.
+    """
+    vdir = os.path.join(youtubecache, video_id)
+    cues_file = os.path.join(vdir, 'transcript.cues.tsv')
+    timed = os.path.exists(cues_file)
+    with open(cues_file if timed else os.path.join(vdir, 'transcript.txt'), 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        offset = cue_offset(f, start) if timed and start is not None else line_start(f, offset)
+        f.seek(offset)
+        cues = []
+        while f.tell() < end and f.tell() - offset < transcript_page_bytes:
+            line = f.readline().decode('utf-8', 'replace').rstrip('\n')
+            if timed:
+                t, _, text = line.partition('\t')
+                cues.append({'t': float(t), 'text': text})
+            elif line:
+                cues.append({'t': None, 'text': line})
+        return cues, f.tell() if f.tell() < end else None
+
+
+class BatchJob:
+    """A task run in the background over many videos, a few at a time"""
+
+    def __init__(self, name, video_ids, fn, skip, workers):
+        self.name = name
+        self.video_ids = list(dict.fromkeys(video_ids))
+        self.fn = fn  # video id -> whether it produced anything
+        self.skip = skip  # video id -> whether it's already done
+        self.workers = workers
+        self.status = 'queued'
+        self.counts = {'saved': 0, 'skipped': 0, 'unavailable': 0, 'failed': 0}
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return dict(self.counts,
+                    status=self.status,
+                    total=len(self.video_ids),
+                    finished=sum(self.counts.values()),
+                    elapsed=round(end - self.started_at, 1) if self.started_at else 0)
+
+
+def run_batch_job(job):
+    """Run the job's task for every video it doesn't skip, job.workers at a time"""
+    job.status = 'running'
+    job.started_at = time.time()
+
+    def run(video_id):
+        try:
+            job.count('saved' if job.fn(video_id) else 'unavailable')
+        except Exception as e:
+            logger.warning(f'{job.name} for {video_id} failed: {e}')
+            job.count('failed')
+
+    try:
+        todo = [x for x in job.video_ids if not job.skip(x)]
+        job.counts['skipped'] = len(job.video_ids) - len(todo)
+        with ThreadPoolExecutor(max_workers=job.workers, thread_name_prefix=job.name) as pool:
+            list(pool.map(run, todo))
+        job.status = 'done'
+        logger.info(f'{job.name} batch finished: {job.counts}')
+    except Exception as e:
+        logger.exception(e)
+        job.status = 'failed'
+    finally:
+        job.finished_at = time.time()
+        job.done.set()
+
+
+batch_jobs = {}  # (task name, key) -> latest BatchJob
+batch_jobs_lock = threading.Lock()
+
+
+def start_batch_job(name, key, video_ids, fn, skip, workers):
+    """Start a background batch for (name, key), unless one is already running.
+
+    Returns None if another worker process is running it.
+    """
+    with batch_jobs_lock, file_lock(f'batch-{name}-{key}'):
+        job = batch_jobs.get((name, key))
+        if job is None or job.done.is_set():
+            state = shared_job(name, key)
+            if state is not None and state['active']:
+                return None
+            job = batch_jobs[(name, key)] = BatchJob(name, video_ids, fn, skip, workers)
+            publish_while_running(job, name, key)
+            threading.Thread(target=run_batch_job, args=(job,), name=name, daemon=True).start()
+        return job
+
+
+def start_transcript_job(key, video_ids):
+    """Fetch transcripts in the background for key ('favorites' or a channel id)"""
+    return start_batch_job('transcripts', key, video_ids, fetch_video_transcript, has_transcript, transcript_workers)
+
+
+def favorite_video_ids():
+    """Favorite videos plus every cached video of a favorite channel"""
+    favs = favorites_store.to_dict()
+    video_ids = list(favs['videos'])
+    for channel in favs['channels']:
+        video_ids += [v['id'] for v in get_channel_videos(channel['id'])]
+    return video_ids
+
+
 @app.route('/transcript/fetch', methods=['POST'])
 def fetch_transcript():
     """Fetch transcript for a video"""
@@ -234,90 +2600,168 @@ def fetch_transcript():
     return_url = request.form.get('return_url', '/youtube')
 
     if video_id:
-        vdir = os.path.join(youtubecache, video_id)
-        if not os.path.exists(vdir):
-            os.makedirs(vdir)
-
+        separator = '&' if '?' in return_url else '?'
         try:
-            # Try to download auto-generated English subtitles first, then manual
-            # Download as .vtt format (easier to parse than .srt)
-            cmd = f'yt-dlp --write-auto-sub --sub-lang en --skip-download --sub-format vtt --output "{vdir}/%(id)s" {video_id}'
-            logger.info(f'Fetching transcript: {cmd}')
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-
-            # If auto-subs failed, try manual subs
-            if result.returncode != 0 or not glob.glob(f'{vdir}/*.vtt'):
-                cmd = f'yt-dlp --write-sub --sub-lang en --skip-download --sub-format vtt --output "{vdir}/%(id)s" {video_id}'
-                logger.info(f'Trying manual subtitles: {cmd}')
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-
-            # Check if we got a subtitle file
-            vtt_files = glob.glob(f'{vdir}/*.vtt')
-            if vtt_files:
-                # Convert VTT to plain text
-                vtt_file = vtt_files[0]
-                transcript_text = convert_vtt_to_text(vtt_file)
-
-                # Save as plain text
-                transcript_file = os.path.join(vdir, 'transcript.txt')
-                with open(transcript_file, 'w') as f:
-                    f.write(transcript_text)
-
-                logger.info(f'Transcript saved: {transcript_file}')
-                separator = '&' if '?' in return_url else '?'
+            if fetch_video_transcript(video_id):
                 return redirect(return_url + separator + 'transcript=success')
-            else:
-                logger.warning(f'No transcript available for {video_id}')
-                separator = '&' if '?' in return_url else '?'
-                return redirect(return_url + separator + 'transcript=unavailable')
-
+            return redirect(return_url + separator + 'transcript=unavailable')
         except Exception as e:
             logger.exception(e)
-            separator = '&' if '?' in return_url else '?'
             return redirect(return_url + separator + 'transcript=error')
 
     return redirect(return_url)
 
 
-def convert_vtt_to_text(vtt_file):
-    """Convert VTT subtitle file to plain text"""
-    import re
+@app.route('/transcript/batch', methods=['POST'])
+def transcript_batch():
+    """Fetch transcripts for all of a channel's cached videos, or for all favorites, in the background"""
+    channel_id = request.form.get('channel_id')
+    return_url = request.form.get('return_url', '/favorites')
+    if channel_id:
+        start_transcript_job(channel_id, [v['id'] for v in get_channel_videos(channel_id)])
+    else:
+        start_transcript_job('favorites', favorite_video_ids())
+    return redirect(return_url)
+
+
+@app.route('/transcript/batch/<key>.json')
+def transcript_batch_status(key):
+    """Progress of the latest transcript batch for a channel id or 'favorites'"""
+    return jsonify(shared_job('transcripts', key) or {'status': 'idle'})
+
+
+@app.route('/transcript/<video_id>.json')
+def transcript_json(video_id):
+    """A page of a video's transcript: ?offset= continues from the previous page, ?t= starts at a time"""
+    try:
+        cues, next_offset = transcript_page(video_id, offset=request.args.get('offset', 0, type=int),
+                                            start=request.args.get('t', type=float))
+    except FileNotFoundError:
+        return jsonify({'error': 'Transcript not found'}), 404
+    return jsonify({'video_id': video_id, 'cues': cues, 'next_offset': next_offset})
 
-    with open(vtt_file, 'r', encoding='utf-8') as f:
-        content = f.read()
 
-    # Remove VTT header
-    content = re.sub(r'WEBVTT\n.*?\n\n', '', content, flags=re.DOTALL)
+THUMBNAIL_SIZES = {'small': 160, 'medium': 480}  # variant -> width in pixels; 'original' is kept as well
 
-    # Remove timestamp lines (e.g., "00:00:00.000 --> 00:00:02.000")
-    content = re.sub(r'\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3}.*?\n', '', content)
+thumbnail_session = requests.Session()
+thumbnail_session.mount('http://', upstream_adapter)
+thumbnail_session.mount('https://', upstream_adapter)
 
-    # Remove cue identifiers (lines that are just numbers)
-    content = re.sub(r'^\d+\n', '', content, flags=re.MULTILINE)
 
-    # Remove VTT tags like <c>, <v>, etc.
-    content = re.sub(r'<[^>]+>', '', content)
+def thumbnail_path(video_id, size):
+    name = 'thumb.jpg' if size == 'original' else f'thumb_{size}.jpg'
+    return os.path.join(youtubecache, video_id, name)
 
-    # Remove alignment tags
-    content = re.sub(r'align:start position:\d+%', '', content)
 
-    # Split into lines and filter out empty ones
-    lines = [line.strip() for line in content.split('\n')]
-    lines = [line for line in lines if line]
+def has_thumbnail(video_id):
+    # the small variant is written last, so it marks a complete set
+    return os.path.exists(thumbnail_path(video_id, 'small'))
 
-    # Join with single newlines, then add paragraph breaks where appropriate
-    # (YouTube captions often have sentences split across lines)
-    text = ' '.join(lines)
 
-    # Replace common sentence-ending patterns with newline breaks
-    text = re.sub(r'\.\s+', '.\n', text)
-    text = re.sub(r'\?\s+', '?\n', text)
-    text = re.sub(r'!\s+', '!\n', text)
+def thumbnail_urls(video_id):
+    """Thumbnail URLs for a video, preferred first, ending with one YouTube always has"""
+    info = load_video_info(video_id)
+    thumbnails = sorted(info.get('thumbnails') or [], key=lambda t: t.get('preference') or 0, reverse=True)
+    urls = [info.get('thumbnail')] + [t.get('url') for t in thumbnails]
+    urls.append(f'https://i.ytimg.com/vi/{video_id}/hqdefault.jpg')
+    return list(dict.fromkeys(x for x in urls if x))
+
+
+def download_thumbnail(video_id):
+    """The first of a video's thumbnails that downloads and decodes, as (bytes, PIL image), or None"""
+    for url in thumbnail_urls(video_id):
+        rate_limiter(urlparse(url).hostname).wait()
+        try:
+            r = thumbnail_session.get(url, timeout=upstream_timeout)
+        except requests.RequestException as e:
+            logger.debug(f'thumbnail {url} failed: {e}')
+            continue
+        if r.status_code != 200:
+            continue  # yt-dlp lists sizes YouTube may not have made for this video
+        try:
+            image = Image.open(io.BytesIO(r.content))
+            image.load()
+        except (OSError, Image.DecompressionBombError):
+            continue
+        return r.content, image
+    return None
 
-    # Collapse multiple blank lines into single blank line
-    text = re.sub(r'\n\n+', '\n\n', text)
 
-    return text.strip()
+def write_image(path, image=None, data=None):
+    tmp_file = tmp_name(path)
+    if data is not None:
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+    else:
+        image.save(tmp_file, 'JPEG', quality=85, optimize=True)
+    os.replace(tmp_file, path)
+
+
+def cache_thumbnail(video_id):
+    """Download a video's preferred thumbnail once and write its resized variants; returns whether it's cached"""
+    if has_thumbnail(video_id):
+        return True
+    with file_lock(f'thumbnail-{video_id}'):
+        if has_thumbnail(video_id):
+            return True
+        found = download_thumbnail(video_id)
+        if found is None:
+            logger.warning(f'No thumbnail available for {video_id}')
+            return False
+        data, image = found
+        if image.format != 'JPEG':
+            data = None
+        image = image.convert('RGB')
+        write_image(thumbnail_path(video_id, 'original'), image, data)
+        # Largest first: the small variant marks a complete set
+        for size, width in sorted(THUMBNAIL_SIZES.items(), key=lambda x: -x[1]):
+            height = max(1, round(image.height * width / image.width))
+            variant = image.resize((width, height), Image.Resampling.LANCZOS) if image.width > width else image
+            write_image(thumbnail_path(video_id, size), variant)
+    index_video_files(video_id)
+    return True
+
+
+def start_thumbnail_backfill():
+    """Cache thumbnails for every indexed video that doesn't have them yet, in the background"""
+    video_ids = [r['id'] for r in get_index_db().execute('SELECT id FROM videos ORDER BY timestamp DESC')]
+    return start_batch_job('thumbnails', 'all', video_ids, cache_thumbnail, has_thumbnail, thumbnail_workers)
+
+
+@app.cli.command('backfill-thumbnails')
+def backfill_thumbnails_command():
+    """Cache thumbnails for every indexed video that doesn't have them yet"""
+    job = start_thumbnail_backfill()
+    if job is None:
+        print('A thumbnail backfill is already running in the server')
+        return
+    job.done.wait()
+    print(f"Thumbnails: {job.counts['saved']} cached, {job.counts['skipped']} already cached, "
+          f"{job.counts['unavailable']} unavailable, {job.counts['failed']} failed")
+
+
+@app.route('/thumbnail/<video_id>/<size>.jpg')
+def thumbnail(video_id, size):
+    """A video's thumbnail (small, medium or original) from youtube_cache, downloaded on first request"""
+    if size != 'original' and size not in THUMBNAIL_SIZES:
+        return 'Unknown thumbnail size', 404
+    if not has_video_data(video_id) or not cache_thumbnail(video_id):
+        return 'Thumbnail not found', 404
+    # send_file adds an ETag and Last-Modified and answers conditional requests
+    return send_file(thumbnail_path(video_id, size), mimetype='image/jpeg', max_age=thumbnail_max_age)
+
+
+@app.route('/thumbnails/backfill', methods=['POST'])
+def thumbnails_backfill():
+    """Start caching thumbnails for the whole library"""
+    start_thumbnail_backfill()
+    return redirect('/controls')
+
+
+@app.route('/thumbnails/backfill.json')
+def thumbnails_backfill_status():
+    """Progress of the latest thumbnail backfill"""
+    return jsonify(shared_job('thumbnails', 'all') or {'status': 'idle'})
 
 
 @app.route('/transcript/download/<video_id>')
@@ -338,8 +2782,6 @@ def download_transcript(video_id):
 @app.route('/delete/video', methods=['POST'])
 def delete_video():
     """Delete a video from cache"""
-    import shutil
-
     video_id = request.form.get('id')
     return_url = request.form.get('return_url', '/youtube')
 
@@ -348,13 +2790,12 @@ def delete_video():
         if os.path.exists(vdir):
             try:
                 shutil.rmtree(vdir)
+                unindex_video(video_id)
                 logger.info(f'Deleted video cache: {video_id}')
 
                 # Also remove from favorites if present
-                favs = load_favorites()
-                if video_id in favs.get('videos', []):
-                    favs['videos'].remove(video_id)
-                    save_favorites(favs)
+                favorites_store.remove_videos(video_id)
+                favorites_store.flush()
 
             except Exception as e:
                 logger.exception(e)
@@ -367,45 +2808,33 @@ def delete_video():
 @app.route('/delete/channel', methods=['POST'])
 def delete_channel():
     """Delete all videos from a channel from cache"""
-    import shutil
-
     channel_id = request.form.get('id')
     return_url = request.form.get('return_url', '/youtube')
 
     if channel_id:
         # Find all videos from this channel
-        vfiles = glob.glob(f'{youtubecache}/*/data.json')
         deleted_count = 0
+        deleted_ids = []
 
-        for vfile in vfiles:
+        for video in get_channel_videos(channel_id):
             try:
-                with open(vfile, 'r') as f:
-                    ds = json.loads(f.read())
-
-                if not ds or not isinstance(ds, dict):
-                    continue
-
-                if ds.get('channel_id') == channel_id:
-                    video_id = ds.get('id')
-                    vdir = os.path.dirname(vfile)
+                video_id = video['id']
+                vdir = os.path.join(youtubecache, video_id)
+                if os.path.exists(vdir):
                     shutil.rmtree(vdir)
-                    deleted_count += 1
-                    logger.info(f'Deleted video cache: {video_id}')
-
-                    # Also remove from favorites if present
-                    favs = load_favorites()
-                    if video_id and video_id in favs.get('videos', []):
-                        favs['videos'].remove(video_id)
-                        save_favorites(favs)
+                unindex_video(video_id)
+                deleted_count += 1
+                deleted_ids.append(video_id)
+                logger.info(f'Deleted video cache: {video_id}')
 
             except Exception as e:
                 logger.exception(e)
                 continue
 
-        # Remove channel from favorites
-        favs = load_favorites()
-        favs['channels'] = [c for c in favs.get('channels', []) if c['id'] != channel_id]
-        save_favorites(favs)
+        # Remove the channel and its videos from favorites
+        favorites_store.remove_videos(*deleted_ids)
+        favorites_store.remove_channel(channel_id)
+        favorites_store.flush()
 
         logger.info(f'Deleted {deleted_count} videos from channel {channel_id}')
 
@@ -415,22 +2844,31 @@ def delete_channel():
 @app.route('/controls')
 def controls():
     """Show admin/control page"""
-    return render_template('controls.html')
+    return render_template('controls.html', web_cache=web_cache.stats(), media=media_usage(),
+                           freed=request.args.get('freed', type=int), metrics=metrics_summary())
+
+
+@app.route('/media/evict', methods=['POST'])
+def evict_media():
+    """Apply the disk quota now instead of after the next download"""
+    return redirect(f'/controls?freed={enforce_media_quota()}')
 
 
 @app.route('/clear-cache', methods=['POST'])
 def clear_cache():
-    """Clear the web request cache but keep downloaded videos"""
+    """Clear the web request cache, or just one site's part of it, but keep downloaded videos"""
     try:
-        # Clear requests cache
-        cache_path = '/tmp/r.cache'
-        if os.path.exists(cache_path):
-            os.remove(cache_path)
-        if os.path.exists(cache_path + '.sqlite'):
-            os.remove(cache_path + '.sqlite')
-
-        # Reinstall the cache to recreate it
-        requests_cache.install_cache('/tmp/r.cache', expire_after=86400)
+        target = request.form.get('target', '').strip()
+        if target:
+            match = cache_target_matcher(target)
+            removed = web_cache.invalidate(match)
+            rewrite_cache_clear(match)
+            logger.info(f'Cleared {removed} cached responses for {target}')
+            return render_template('cache_cleared.html', target=target, removed=removed)
+
+        # Cleared in place rather than by deleting the database under open connections
+        web_cache.clear()
+        rewrite_cache_clear()
 
         logger.info('Cache cleared successfully (videos preserved)')
         return render_template('cache_cleared.html')
@@ -439,48 +2877,92 @@ def clear_cache():
         return f'Error clearing cache: {str(e)}', 500
 
 
-def fetch_channel_updates(channel_id, playlist_end=50, batch_size=20):
-    """Fetch new videos for a channel without removing existing cache.
+THROTTLED_RE = re.compile(r'HTTP Error 429|Too Many Requests|rate.?limit', re.I)
+
+
+class RateLimiter:
+    """Spaces out requests to one host and backs off while it is throttling us"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_at = 0.0
+        self.penalty = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request to the host may start"""
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_at)
+            self.next_at = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def backoff(self):
+        """Hold off all requests to the host for twice as long as last time; returns the delay"""
+        with self.lock:
+            self.penalty = min(max(self.penalty * 2, 1.0), rate_limit_max_backoff)
+            self.next_at = max(self.next_at, time.monotonic() + self.penalty)
+            return self.penalty
+
+    def ok(self):
+        with self.lock:
+            self.penalty = 0.0
+
+
+_rate_limiters = {}  # host -> RateLimiter
+_rate_limiters_lock = threading.Lock()
+refresh_slots = threading.BoundedSemaphore(refresh_workers)
+
+
+def rate_limiter(host):
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(youtube_rate)
+        return _rate_limiters[host]
+
+
+def throttled(host, fn, *args, **kwargs):
+    """Call fn within the global refresh concurrency limit and host's rate limit, retrying when throttled"""
+    limiter = rate_limiter(host)
+    for attempt in range(refresh_retries + 1):
+        limiter.wait()
+        with refresh_slots:
+            try:
+                result = fn(*args, **kwargs)
+            except yt_dlp.utils.DownloadError as e:
+                if attempt == refresh_retries or not THROTTLED_RE.search(str(e)):
+                    raise
+                delay = limiter.backoff()
+                logger.warning(f'{host} is throttling requests; backing off {delay:.0f}s')
+                continue
+        limiter.ok()
+        return result
 
-    Uses batched yt-dlp metadata fetches to cut down on per-video calls.
-    """
-    channel_url = f"https://www.youtube.com/channel/{channel_id}/videos"
-    cmd = f'yt-dlp --dump-json --flat-playlist --playlist-end {playlist_end} "{channel_url}"'
-    logger.info(f'Updating channel {channel_id}: {cmd}')
 
-    pid = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    lines = pid.stdout.decode('utf-8').strip().split('\n')
+def channel_missing_ids(channel_id, playlist_end):
+    """Ids of a channel's latest videos that are not cached (or whose cached metadata is unreadable)"""
+    channel_url = f"https://www.youtube.com/channel/{channel_id}/videos"
+    logger.info(f'Updating channel {channel_id}: {channel_url} (up to {playlist_end})')
 
-    new_count = 0
     missing_ids = []
-    for line in lines:
-        if not line.strip():
-            continue
+    for video_data in throttled('www.youtube.com', ytdl_playlist, channel_url, playlist_end):
         try:
-            video_data = json.loads(line)
             video_id = video_data.get('id')
 
             if not video_id:
                 continue
 
             # Check if video is already cached with valid JSON
-            vdir = os.path.join(youtubecache, video_id)
-            dfile = os.path.join(vdir, 'data.json')
-
             needs_refresh = False
-            if os.path.exists(dfile):
+            if has_video_data(video_id):
                 try:
-                    with open(dfile) as df:
-                        cached = json.load(df)
+                    cached = load_video_summary(video_id)
                     if not isinstance(cached, dict) or cached.get('id') != video_id:
                         needs_refresh = True
                 except Exception:
                     # Corrupt or empty file; refresh it
                     needs_refresh = True
-                    try:
-                        os.remove(dfile)
-                    except OSError:
-                        pass
             else:
                 needs_refresh = True
 
@@ -491,37 +2973,283 @@ def fetch_channel_updates(channel_id, playlist_end=50, batch_size=20):
             logger.exception(e)
             continue
 
-    # Fetch metadata in batches to reduce per-video process overhead
-    for i in range(0, len(missing_ids), batch_size):
-        batch = missing_ids[i:i + batch_size]
-        meta_cmd = ['yt-dlp', '-J'] + batch
-        logger.info(f'Fetching metadata for batch ({len(batch)})')
-        meta_pid = subprocess.run(meta_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        meta_output = meta_pid.stdout.decode('utf-8').strip().split('\n')
+    return missing_ids
+
+
+def fetch_video_metadata(video_id):
+    """Extract and cache one video's metadata; returns whether it was saved"""
+    meta = throttled('www.youtube.com', ytdl_extract, video_id)
+    if not isinstance(meta, dict) or not meta.get('id'):
+        return False
+    save_video_data(meta)
+    return True
+
+
+class RefreshJob:
+    """A refresh of the latest uploads of one or more channels"""
+
+    def __init__(self, channel_ids, playlist_end=50):
+        self.playlist_end = playlist_end
+        self.channels = {cid: {'id': cid, 'status': 'queued', 'missing': 0, 'remaining': 0, 'new': 0, 'error': None}
+                         for cid in channel_ids}
+        self.status = 'queued'
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    @property
+    def new_count(self):
+        return sum(c['new'] for c in self.channels.values())
+
+    def to_dict(self):
+        channels = list(self.channels.values())
+        end = self.finished_at or time.time()
+        return {
+            'status': self.status,
+            'channels_total': len(channels),
+            'channels_done': sum(c['status'] in ('done', 'failed') for c in channels),
+            'videos_remaining': sum(c['remaining'] for c in channels),
+            'new': self.new_count,
+            'failed': [c for c in channels if c['status'] == 'failed'],
+            'elapsed': round(end - self.started_at, 1) if self.started_at else 0,
+        }
+
+
+def run_refresh(job):
+    """Fetch each channel's playlist, then the metadata of its uncached videos.
+
+    Playlists and metadata are fetched concurrently; a channel's videos are
+    queued as soon as its playlist arrives rather than after every playlist.
+    """
+    job.status = 'running'
+    job.started_at = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='refresh') as pool:
+            pending = {pool.submit(channel_missing_ids, cid, job.playlist_end): (cid, None) for cid in job.channels}
+            for channel in job.channels.values():
+                channel['status'] = 'listing'
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    channel_id, video_id = pending.pop(future)
+                    channel = job.channels[channel_id]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning(f'Refreshing {video_id or channel_id} failed: {e}')
+                        channel['error'] = str(e)
+                        result = None
+
+                    if video_id is None:
+                        if result is None:
+                            channel['status'] = 'failed'
+                            continue
+                        channel['missing'] = channel['remaining'] = len(result)
+                        channel['status'] = 'fetching'
+                        for vid in result:
+                            pending[pool.submit(fetch_video_metadata, vid)] = (channel_id, vid)
+                    else:
+                        channel['remaining'] -= 1
+                        channel['new'] += bool(result)
+                    if channel['status'] == 'fetching' and not channel['remaining']:
+                        channel['status'] = 'done'
+                        logger.info(f'Found {channel["new"]} new videos for channel {channel_id}')
+        job.status = 'done'
+    except Exception as e:
+        logger.exception(e)
+        job.status = 'failed'
+    finally:
+        job.finished_at = time.time()
+        job.done.set()
 
-        for meta_line in meta_output:
-            if not meta_line.strip():
-                continue
-            try:
-                meta = json.loads(meta_line)
-                if not isinstance(meta, dict):
-                    continue
-                video_id = meta.get('id')
-                if not video_id:
-                    continue
 
-                vdir = os.path.join(youtubecache, video_id)
-                dfile = os.path.join(vdir, 'data.json')
-                if not os.path.exists(vdir):
-                    os.makedirs(vdir)
-                with open(dfile, 'w') as f:
-                    f.write(json.dumps(meta, indent=2))
-                new_count += 1
-            except Exception as e:
-                logger.exception(e)
+def fetch_channel_updates(channel_id, playlist_end=50):
+    """Fetch new videos for a channel without removing existing cache.
+
+    Metadata comes from the warm in-process yt-dlp pool, so only videos that
+    are missing from the cache cost an extraction.
+    """
+    job = RefreshJob([channel_id], playlist_end)
+    run_refresh(job)
+    channel = job.channels[channel_id]
+    if channel['status'] == 'failed':
+        raise RuntimeError(channel['error'])
+    return channel['new']
+
+
+favorites_refresh = None  # the latest favorites refresh started by this process
+favorites_refresh_lock = threading.Lock()
+favorites_refresh_stamp = os.path.join(lock_dir, 'refresh-favorites.last')
+
+
+def run_favorites_refresh(job, scheduled=False):
+    """Refresh favorite channels; worker processes take turns"""
+    with file_lock('refresh-favorites'):
+        try:
+            last = os.path.getmtime(favorites_refresh_stamp)
+        except FileNotFoundError:
+            last = 0
+        if scheduled and time.time() - last < refresh_interval:
+            # Another worker ran this interval's refresh while we waited
+            job.status = 'skipped'
+            job.finished_at = time.time()
+            job.done.set()
+            return
+        logger.info(f'Refreshing {len(job.channels)} favorite channels')
+        # Published once it holds the lock, so a refresh queued behind another
+        # worker's doesn't hide that one's progress
+        publish_while_running(job, 'refresh', 'favorites')
+        run_refresh(job)
+        with open(favorites_refresh_stamp, 'w'):
+            pass
+        logger.info(f'Refreshed favorite channels: {job.new_count} new videos in {job.finished_at - job.started_at:.0f}s')
+
+
+def start_favorites_refresh(scheduled=False, playlist_end=50):
+    """Start refreshing every favorite channel in the background, unless a refresh is already running.
+
+    Returns None if another worker process is running one.
+    """
+    global favorites_refresh
+    with favorites_refresh_lock:
+        if favorites_refresh is None or favorites_refresh.done.is_set():
+            state = shared_job('refresh', 'favorites')
+            if not scheduled and state is not None and state['active']:
+                return None
+            channel_ids = [c['id'] for c in favorites_store.to_dict()['channels']]
+            favorites_refresh = RefreshJob(channel_ids, playlist_end)
+            threading.Thread(target=run_favorites_refresh, args=(favorites_refresh, scheduled),
+                             name='refresh-favorites', daemon=True).start()
+        return favorites_refresh
+
+
+def refresh_loop():
+    """Refresh favorite channels every refresh_interval seconds"""
+    while True:
+        try:
+            start_favorites_refresh(scheduled=True).done.wait()
+        except Exception as e:
+            logger.exception(e)
+        time.sleep(refresh_interval)
+
+
+def start_refresh_scheduler():
+    """Start the periodic favorites refresh, if ADHDPROXY_REFRESH_INTERVAL is set"""
+    if not refresh_interval:
+        return None
+    thread = threading.Thread(target=refresh_loop, name='refresh-scheduler', daemon=True)
+    thread.start()
+    return thread
+
+
+YOUTUBE_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+
+
+def youtube_video_id(url):
+    """The video id in a YouTube watch, shorts, embed or youtu.be URL, or None"""
+    o = urlparse(url)
+    host = o.hostname or ''
+    if host == 'youtu.be':
+        candidate = o.path.split('/')[1] if '/' in o.path else ''
+    elif host == 'youtube.com' or host.endswith('.youtube.com'):
+        if o.path == '/watch':
+            candidate = parse_qs(o.query).get('v', [''])[0]
+        elif o.path.startswith(('/shorts/', '/embed/', '/live/')):
+            candidate = o.path.split('/')[2]
+        else:
+            return None
+    else:
+        return None
+    return candidate if YOUTUBE_ID_RE.fullmatch(candidate) else None
+
+
+def format_filename(video_id, vformat):
+    """Cache file name for one format of a video: {video_id}_{format_id}.{ext}"""
+    if vformat['video_ext'] != 'none':
+        return video_id + '_' + vformat['format_id'] + '.' + vformat['video_ext']
+    elif vformat['audio_ext'] != 'none':
+        return video_id + '_' + vformat['format_id'] + '.' + vformat['audio_ext']
+    return video_id + '_' + vformat['format_id'] + '.vid'
+
+
+def default_format(info):
+    """The format to prefetch: the best single-file (audio and video) format up to prefetch_max_height, mp4 first"""
+    formats = [f for f in info.get('formats') or []
+               if f.get('vcodec', 'none') != 'none' and f.get('acodec', 'none') != 'none'
+               and (f.get('height') or 0) <= prefetch_max_height]
+    if not formats:
+        return None
+    return max(formats, key=lambda f: (f.get('ext') == 'mp4', f.get('height') or 0, f.get('tbr') or 0))
 
-    logger.info(f'Found {new_count} new videos for channel {channel_id}')
-    return new_count
+
+def get_video_info(video_id):
+    """A video's full yt-dlp info, extracted and cached first if needed"""
+    if has_video_data(video_id):
+        return load_video_info(video_id)
+    logger.debug(f'fetching metadata for {video_id}')
+    ds = throttled('www.youtube.com', ytdl_extract, video_id)
+    save_video_data(ds)
+    return ds
+
+
+def prefetch_youtube_video(video_id, download=True):
+    """Cache a video's metadata and start downloading its default format in the background.
+
+    Returns the default format, or None if the video has no single-file
+    format. Only the metadata is fetched before returning.
+    """
+    vformat = default_format(get_video_info(video_id))
+    if vformat is None or not download:
+        return vformat
+    filename = format_filename(video_id, vformat)
+    if not os.path.exists(os.path.join(youtubecache, video_id, filename)):
+        submit_download(video_id, vformat['format_id'], filename, vformat.get('filesize'))
+    return vformat
+
+
+readahead_queue = queue.Queue(maxsize=readahead_queue_size)
+_readahead_seen = OrderedDict()  # video ids already queued by this process, oldest first
+_readahead_lock = threading.Lock()
+_readahead_thread = None
+
+
+def readahead(video_ids):
+    """Queue videos linked from a page to be cached in the background, if read-ahead is on"""
+    global _readahead_thread
+    if not readahead_per_hour:
+        return
+    with _readahead_lock:
+        if _readahead_thread is None:
+            _readahead_thread = threading.Thread(target=readahead_loop, name='readahead', daemon=True)
+            _readahead_thread.start()
+        for video_id in video_ids:
+            if video_id in _readahead_seen:
+                continue
+            try:
+                readahead_queue.put_nowait(video_id)
+            except queue.Full:
+                return  # dropped, not marked seen, so a later page can queue it again
+            _readahead_seen[video_id] = True
+            if len(_readahead_seen) > 10000:
+                _readahead_seen.popitem(last=False)
+
+
+def readahead_loop():
+    """Cache queued videos, at most readahead_per_hour of them in any hour"""
+    recent = []  # when each of the last hour's read-aheads started
+    while True:
+        video_id = readahead_queue.get()
+        if has_video_data(video_id) and not readahead_media:
+            continue
+        recent = [t for t in recent if time.time() - t < 3600]
+        if len(recent) >= readahead_per_hour:
+            time.sleep(3600 - (time.time() - recent[0]))
+            recent.pop(0)
+        recent.append(time.time())
+        try:
+            prefetch_youtube_video(video_id, download=readahead_media)
+        except Exception as e:
+            logger.warning(f'Read-ahead of {video_id} failed: {e}')
 
 
 @app.route('/youtube/channel/<channel_id>/update', methods=['POST'])
@@ -550,45 +3278,15 @@ def youtube_channel_refresh_all(channel_id):
 @app.route('/youtube/channel/<channel_id>')
 def youtube_channel(channel_id):
     """Show all cached videos from a specific channel"""
-    vfiles = glob.glob(f'{youtubecache}/*/data.json')
-    channel_videos = []
-    channel_name = "Unknown Channel"
-
-    for vfile in vfiles:
-        # Skip obviously bad paths (e.g., artifacts with query params)
-        if '?' in vfile:
-            logger.warning(f'Skipping malformed path: {vfile}')
-            continue
-        try:
-            with open(vfile, 'r') as f:
-                ds = json.loads(f.read())
-
-                # Skip if data is invalid
-                if not ds or not isinstance(ds, dict):
-                    logger.warning(f'Skipping invalid data file: {vfile}')
-                    continue
-
-                if ds.get('channel_id') == channel_id:
-                    channel_videos.append({
-                        'id': ds['id'],
-                        'title': ds['title'],
-                        'upload_date': ds.get('upload_date'),
-                        'timestamp': ds.get('timestamp', 0),
-                        'duration_string': ds.get('duration_string')
-                    })
-                    # Get channel name from first video
-                    if channel_name == "Unknown Channel":
-                        channel_name = ds.get('uploader') or ds.get('channel', 'Unknown Channel')
-        except Exception as e:
-            logger.warning(f'Skipping unreadable data file {vfile}: {e}')
-            continue
-
-    # Sort by timestamp (newest first)
-    channel_videos.sort(key=lambda x: x['timestamp'], reverse=True)
+    channel_videos = get_channel_videos(channel_id)
+    channel = get_channel(channel_id) or {}
+    if readahead_media:
+        # Their metadata is cached already; read ahead the media
+        readahead([v['id'] for v in channel_videos[:readahead_channel_videos]])
+    channel_name = channel.get('name') or "Unknown Channel"
 
     # Check if channel is favorited
-    favs = load_favorites()
-    is_favorited = any(c['id'] == channel_id for c in favs.get('channels', []))
+    is_favorited = favorites_store.has_channel(channel_id)
 
     # Check for update notification
     updated_count = request.args.get('updated')
@@ -599,6 +3297,8 @@ def youtube_channel(channel_id):
                          channel_id=channel_id,
                          videos=channel_videos,
                          video_count=len(channel_videos),
+                         total_duration=channel.get('total_duration', 0),
+                         total_bytes=channel.get('total_bytes', 0),
                          is_favorited=is_favorited,
                          updated_count=updated_count,
                          update_error=update_error)
@@ -615,8 +3315,8 @@ def youtube():
     formatid = request.args.get('format')
     audio_only = request.args.get('audio_only')
     video_only = request.args.get('video_only')
-    per_page = int(request.args.get('per_page', 10))  # default 10 results per page
-    page = int(request.args.get('page', 1))  # default page 1
+    per_page = request.args.get('per_page', 10, type=int)  # default 10 results per page
+    page = request.args.get('page', 1, type=int)  # default page 1
     logger.debug(f'videoid: {videoid} formatid:{formatid} audio:{audio_only} video:{video_only}')
     logger.debug(f'per_page: {per_page} page: {page}')
     logger.debug('---------------------------')
@@ -630,15 +3330,14 @@ def youtube():
         vdir = os.path.join(youtubecache, videoid)
         if not os.path.exists(vdir):
             os.makedirs(vdir)
-        df = os.path.join(vdir, 'data.json')
-        if not os.path.exists(df):
-            cmd = f'yt-dlp -J {videoid} | tee -a {df}'
-            logger.debug(cmd)
-            subprocess.run(cmd, shell=True)
-        with open(df, 'r') as f:
-            ds = json.loads(f.read())
+        try:
+            ds = get_video_info(videoid)
+        except yt_dlp.utils.DownloadError as e:
+            logger.warning(f'Could not get video info for {videoid}: {e}')
+            return f'Video unavailable: {videoid}', 502
 
         videofile = None
+        download = None
         if formatid:
             for vformat in ds['formats']:
                 print(vformat)
@@ -649,31 +3348,16 @@ def youtube():
             logger.debug(vformat)
             logger.debug('####################################')
 
-            if vformat['video_ext'] != 'none':
-                videofile = videoid + '_' + formatid + '.' + vformat['video_ext']
-            elif vformat['audio_ext'] != 'none':
-                videofile = videoid + '_' + formatid + '.' + vformat['audio_ext']
-            else:
-                videofile = videoid + '_' + formatid + '.vid'
-
+            videofile = format_filename(videoid, vformat)
             vfilepath = os.path.join(vdir, videofile)
+            record_media_access(videoid, videofile)
             if not os.path.exists(vfilepath):
-                #cmd = f'yt-dlp --keep-video --format {formatid} --extract-audio --output {videofile} {videoid}'
-                cmd = f'yt-dlp --keep-video --format {formatid} --output {videofile} {videoid}'
-                logger.debug(cmd)
-                subprocess.run(cmd, cwd=vdir, shell=True)
+                # Download in the background; the player streams the file as it
+                # arrives and the page polls the job for progress
+                download = submit_download(videoid, formatid, videofile, vformat.get('filesize')).to_dict()
 
         #cmd = 'yt-dlp --keep-video --extract-audio {videoid}'
-        favs = load_favorites()
-        is_favorited = videoid in favs.get('videos', [])
-
-        # Check for transcript
-        transcript_file = os.path.join(vdir, 'transcript.txt')
-        transcript = None
-        has_transcript = os.path.exists(transcript_file)
-        if has_transcript:
-            with open(transcript_file, 'r', encoding='utf-8') as f:
-                transcript = f.read()
+        is_favorited = favorites_store.has_video(videoid)
 
         # Check for transcript status messages
         transcript_status = request.args.get('transcript')
@@ -681,143 +3365,162 @@ def youtube():
         return render_template('youtube-video.html',
                              video=ds,
                              videofile=videofile,
+                             download=download,
                              is_favorited=is_favorited,
-                             has_transcript=has_transcript,
-                             transcript=transcript,
+                             has_transcript=has_transcript(videoid),
                              transcript_status=transcript_status)
 
-    videos = []
-
-    # list what has already been cached
-    vfiles = glob.glob(f'{youtubecache}/*/data.json')
-    all_cached = []
-    all_tags = set()
-    all_categories = set()
-
-    for vfile in vfiles:
-        logger.debug(f'read {vfile}')
-        try:
-            with open(vfile, 'r') as f:
-                ds = json.loads(f.read())
-
-            # Skip if data is invalid
-            if not ds or not isinstance(ds, dict) or 'id' not in ds:
-                logger.warning(f'Skipping invalid data file: {vfile}')
-                continue
-
-            video_info = {
-                'id': ds['id'],
-                'title': ds['title'],
-                'upload_date': ds.get('upload_date'),
-                'timestamp': ds.get('timestamp', 0),
-                'uploader': ds.get('uploader'),
-                'channel_id': ds.get('channel_id'),
-                'tags': ds.get('tags') or [],
-                'categories': ds.get('categories') or []
-            }
-            all_cached.append(video_info)
-
-            for t in video_info['tags']:
-                if isinstance(t, str):
-                    all_tags.add(t)
-            for c in video_info['categories']:
-                if isinstance(c, str):
-                    all_categories.add(c)
-
-        except Exception as e:
-            logger.exception(e)
-
     # Filters
-    filter_tag = request.args.get('tag')
-    filter_category = request.args.get('category')
+    filter_tags = [x for x in request.args.getlist('tag') if x]
+    filter_categories = [x for x in request.args.getlist('category') if x]
     filter_text = request.args.get('s')
+    sort = request.args.get('sort') or ('relevance' if filter_text else 'newest')
+    after = request.args.get('after')
+    limit = library_limit()
+
+    videos, next_cursor = query_library(sort=sort, after=after, limit=limit, tags=filter_tags,
+                                        categories=filter_categories, text=filter_text)
+    total = get_index_db().execute('SELECT COUNT(*) FROM videos').fetchone()[0]
 
-    if filter_tag:
-        all_cached = [v for v in all_cached if filter_tag in v.get('tags', [])]
-    if filter_category:
-        all_cached = [v for v in all_cached if filter_category in v.get('categories', [])]
+    # Query string for the next page, carrying every active filter
+    list_args = [('sort', sort), ('per_page', limit)]
+    list_args += [('tag', x) for x in filter_tags] + [('category', x) for x in filter_categories]
     if filter_text:
-        needle = filter_text.lower()
-        filtered = []
-        for v in all_cached:
-            # Build a flattened string of all values in the metadata dict
-            haystack = []
-            for val in v.values():
-                if isinstance(val, str):
-                    haystack.append(val)
-                elif isinstance(val, (list, tuple)):
-                    haystack.extend([str(x) for x in val])
-                elif val is not None:
-                    haystack.append(str(val))
-            joined = ' '.join(haystack).lower()
-            if needle in joined:
-                filtered.append(v)
-        all_cached = filtered
-
-    # Sort cached results by timestamp (newest first)
-    all_cached.sort(key=lambda x: x['timestamp'], reverse=True)
-
-    # No pagination on main list; show all cached
-    videos = all_cached
-    has_next = False
-    has_prev = False
+        list_args.append(('s', filter_text))
+
+    active_filters = []
+    for kind, values in (('tag', filter_tags), ('category', filter_categories)):
+        for value in values:
+            remaining = [x for x in list_args if x != (kind, value)]
+            active_filters.append({'kind': kind, 'value': value,
+                                   'remove_url': '/youtube?' + urlencode(remaining)})
 
     return render_template('youtube.html',
                          videos=videos,
                          query=None,
                          page=1,
-                         per_page=len(videos),
-                         has_next=has_next,
-                         has_prev=has_prev,
-                         filter_tag=filter_tag,
-                         filter_category=filter_category,
+                         per_page=limit,
+                         has_next=next_cursor is not None,
+                         has_prev=after is not None,
+                         next_cursor=next_cursor,
+                         list_query=urlencode(list_args),
+                         sort=sort,
+                         sorts=(['relevance'] if filter_text else []) + list(LIBRARY_SORTS),
+                         total=total,
+                         active_filters=active_filters,
+                         filter_tags=filter_tags,
+                         filter_categories=filter_categories,
                          filter_text=filter_text,
-                         tags=sorted(all_tags),
-                         categories=sorted(all_categories))
+                         tags=top_facets('tag'),
+                         categories=top_facets('category'))
+
+
+def library_limit():
+    """Page size from per_page, kept between 1 and library_max_page_size"""
+    limit = request.args.get('per_page', library_page_size, type=int)
+    return max(1, min(limit, library_max_page_size))
+
+
+@app.route('/youtube/library.json')
+def youtube_library_json():
+    """A page of cached videos as JSON, for incremental loading of /youtube"""
+    filter_text = request.args.get('s')
+    sort = request.args.get('sort') or ('relevance' if filter_text else 'newest')
+    limit = library_limit()
+    videos, next_cursor = query_library(sort=sort,
+                                        after=request.args.get('after'),
+                                        limit=limit,
+                                        tags=[x for x in request.args.getlist('tag') if x],
+                                        categories=[x for x in request.args.getlist('category') if x],
+                                        text=filter_text)
+    return jsonify({'videos': videos, 'next': next_cursor})
+
+
+class SearchResults:
+    """The results of one YouTube search, loaded as far as pages have asked for"""
+
+    def __init__(self, query):
+        self.query = query
+        self.ids = []  # in search order
+        self.videos = {}  # id -> summary
+        self.exhausted = False
+        self.created_at = time.time()
+        self.lock = threading.Lock()
+
+    def extend(self, count):
+        """Load at least the first count results, or all there are.
+
+        The flat search only lists ids; full metadata is extracted just for
+        results that are neither loaded nor cached, so a later page costs
+        only its own new videos.
+        """
+        with self.lock:
+            if len(self.ids) < count and not self.exhausted:
+                found = [x['id'] for x in throttled('www.youtube.com', ytdl_search, self.query, count)
+                         if x.get('id')]
+                self.exhausted = len(found) < count
+                # Keep earlier pages stable if the ranking shifted between fetches
+                seen = set(self.ids)
+                self.ids += [x for x in found if x not in seen and not seen.add(x)]
+
+            missing = [x for x in self.ids[:count] if x not in self.videos]
+            uncached = []
+            for video_id in missing:
+                try:
+                    self.videos[video_id] = load_video_summary(video_id)
+                except Exception:
+                    uncached.append(video_id)
+            if uncached:
+                logger.debug(f'extracting {len(uncached)} new search results: {self.query}')
+                with ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='search') as pool:
+                    for video_id, saved in zip(uncached, pool.map(self.fetch, uncached)):
+                        if saved:
+                            self.videos[video_id] = load_video_summary(video_id)
+
+            return [self.videos[x] for x in self.ids[:count] if x in self.videos]
+
+    @staticmethod
+    def fetch(video_id):
+        try:
+            return fetch_video_metadata(video_id)
+        except Exception as e:
+            logger.exception(e)
+            return False
+
+
+search_cache = OrderedDict()  # normalized query -> SearchResults, least recently used first
+search_cache_lock = threading.Lock()
 
 
+def get_search_results(query):
+    """The cached result set for a query, or a new one if it is missing or expired"""
+    key = ' '.join(query.split()).lower()
+    with search_cache_lock:
+        results = search_cache.get(key)
+        if results is None or time.time() - results.created_at > search_cache_ttl:
+            results = search_cache[key] = SearchResults(query)
+        search_cache.move_to_end(key)
+        while len(search_cache) > search_cache_size:
+            search_cache.popitem(last=False)
+    return results
+
 
 @app.route('/youtube/search')
 def youtube_search():
     """Dedicated search view for YouTube queries."""
     q = request.args.get('q')
-    per_page = int(request.args.get('per_page', 10))
-    page = int(request.args.get('page', 1))
+    per_page = max(1, min(request.args.get('per_page', 10, type=int), 50))
+    page = max(1, request.args.get('page', 1, type=int))
 
     if not q:
         return redirect('/youtube')
 
     fetch_count = per_page * page + 1
-    cmd = f'yt-dlp --dump-json --clean-info-json --dump-single-json "ytsearch{fetch_count}:{q}"'
-    logger.debug(cmd)
-    pid = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
-    lines = pid.stdout.decode('utf-8').split('\n')
-    all_videos = []
-    for line in lines:
-        try:
-            ds = json.loads(line)
-            all_videos.append({
-                'id': ds['id'],
-                'title': ds['title'],
-                'upload_date': ds.get('upload_date'),
-                'timestamp': ds.get('timestamp', 0)
-            })
-
-            vid = ds['id']
-            vdir = os.path.join(youtubecache, vid)
-            if not os.path.exists(vdir):
-                os.makedirs(vdir)
-            dfile = os.path.join(vdir, 'data.json')
-            if not os.path.exists(dfile):
-                with open(dfile, 'w') as f:
-                    f.write(json.dumps(ds, indent=2))
-
-        except Exception as e:
-            logger.exception(e)
-            continue
+    logger.debug(f'searching for {fetch_count} results: {q}')
+    all_videos = get_search_results(q).extend(fetch_count)
 
     # Sort by timestamp (newest first)
-    all_videos.sort(key=lambda x: x['timestamp'], reverse=True)
+    all_videos = sorted(all_videos, key=lambda x: x.get('timestamp') or 0, reverse=True)
 
     # Pagination logic: take only the results for current page
     start_idx = (page - 1) * per_page
@@ -842,39 +3545,8 @@ def youtube_search():
 @app.route('/creators')
 def creators():
     """List cached creators."""
-    vfiles = glob.glob(f'{youtubecache}/*/data.json')
-    creators = {}
-
-    for vfile in vfiles:
-        # skip malformed path names
-        if '?' in vfile:
-            continue
-        try:
-            with open(vfile, 'r') as f:
-                ds = json.loads(f.read())
-
-            if not ds or not isinstance(ds, dict) or 'id' not in ds:
-                continue
-
-            channel_id = ds.get('channel_id')
-            if not channel_id:
-                continue
-
-            if channel_id not in creators:
-                creators[channel_id] = {
-                    'name': ds.get('uploader', 'Unknown'),
-                    'channel_id': channel_id,
-                    'video_count': 0,
-                    'latest_timestamp': 0
-                }
-            creators[channel_id]['video_count'] += 1
-            if ds.get('timestamp', 0) > creators[channel_id]['latest_timestamp']:
-                creators[channel_id]['latest_timestamp'] = ds.get('timestamp', 0)
-
-        except Exception as e:
-            logger.exception(e)
-
-    creators_list = sorted(creators.values(), key=lambda x: x['video_count'], reverse=True)
+    rows = get_index_db().execute('SELECT * FROM channels ORDER BY video_count DESC')
+    creators_list = [dict(r, name=r['name'] or 'Unknown') for r in rows]
 
     return render_template('creators.html', creators=creators_list)
 
@@ -893,16 +3565,22 @@ def abstract_path(path):
     if not path:
         return render_template('index.html')
 
-    if ('youtube.com/watch?') in path:
-        realurl = path.replace('https.', 'https://')
-        realurl = path.replace('http.', 'http://')
-        if not realurl.startswith('http'):
-            realurl = 'https://' + realurl
-        #import epdb; epdb.st()
-        vpath = prefetch_youtube_video(realurl)
-        #return jsonify(vpaths)
-        logger.debug('disk path for video: %s' % vpath)
-        return send_from_directory(os.path.dirname(vpath), os.path.basename(vpath))
+    realurl = re.sub(r'^(https?)\.', r'\1://', path)
+    if not realurl.startswith('http'):
+        realurl = 'https://' + realurl
+    # Watch, shorts, embed and youtu.be links play from youtube_cache; the
+    # video page streams the default format while it downloads
+    video_id = youtube_video_id(realurl)
+    if video_id:
+        try:
+            vformat = prefetch_youtube_video(video_id)
+        except yt_dlp.utils.DownloadError as e:
+            # Private, removed or otherwise unavailable; let YouTube's page say so
+            logger.warning(f'Could not cache {video_id}: {e}')
+            return do_link(path)
+        if vformat is None:
+            return redirect(f'/youtube?video={video_id}')
+        return redirect(f"/youtube?video={video_id}&format={quote_plus(vformat['format_id'])}")
 
     return do_link(path)
 
@@ -921,4 +3599,11 @@ if __name__ == "__main__":
     else:
         ssl_context = 'adhoc'
 
+    # Keep the metadata index in step with changes made outside the app, and
+    # refresh favorite channels on a schedule if one is configured
+    if not debug_mode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        clear_shared_state()
+        start_reconciler()
+        start_refresh_scheduler()
+
     app.run(host='0.0.0.0', port=5002, debug=debug_mode, ssl_context=ssl_context)
@@ -0,0 +1,37 @@
+"""gunicorn settings for production (FLASK_ENV=production, see entrypoint.sh)"""
+
+import multiprocessing
+import os
+import shutil
+
+bind = '0.0.0.0:5002'
+workers = int(os.environ.get('ADHDPROXY_WORKERS', multiprocessing.cpu_count()))
+# Threads, because proxied pages and video streams spend most of their time waiting
+worker_class = 'gthread'
+threads = int(os.environ.get('ADHDPROXY_THREADS', 32))
+timeout = 120
+keepalive = 5
+accesslog = '-'
+
+if os.path.exists('/app/certs/cert.pem') and os.path.exists('/app/certs/key.pem'):
+    certfile = '/app/certs/cert.pem'
+    keyfile = '/app/certs/key.pem'
+
+raw_env = ['FLASK_ENV=production']
+
+
+def on_starting(server):
+    """Job statuses and metrics snapshots of a previous run's workers don't apply to this one.
+    flaskapp isn't imported here, so workers don't inherit its state from the arbiter."""
+    lock_dir = os.environ.get('ADHDPROXY_LOCK_DIR', '/tmp/adhdproxy-locks')
+    for name in ('jobs', 'metrics'):
+        shutil.rmtree(os.path.join(lock_dir, name), ignore_errors=True)
+
+
+def post_worker_init(worker):
+    """Every worker runs the index reconciler and refresh scheduler; file locks let one run per pass.
+    Workers also snapshot their metrics so /metrics can add up all of them."""
+    import flaskapp
+    flaskapp.start_reconciler()
+    flaskapp.start_refresh_scheduler()
+    flaskapp.start_metrics_flusher()